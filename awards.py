@@ -0,0 +1,94 @@
+from google.appengine.api import mail
+from google.appengine.api import taskqueue
+from google.appengine.ext import db
+
+EVENT_NAME = "UB Hacking"
+ADMIN_EMAIL = "admin_email@example.com"
+
+# Thresholds that earn a prize, by counter kind ("scope:nature").
+MILESTONES = {
+        "global:commit": [100, 150, 200, 250, 500, 750, 1000],
+        "global:curse": [50, 100, 250],
+        "repo:commit": [100, 250],
+        "repo:curse": [25],
+        "author:commit": [50, 100],
+        "author:curse": [10],
+}
+
+class Milestone(db.Model):
+        counter = db.StringProperty(required=True)
+        threshold = db.IntegerProperty(required=True)
+        author_name = db.StringProperty()
+        author_email = db.StringProperty()
+        sent = db.BooleanProperty(default=False)
+        reached = db.DateTimeProperty(auto_now_add=True)
+
+def ordinal(n):
+        if 10 <= n % 100 <= 20:
+                suffix = "th"
+        else:
+                suffix = {1: "st", 2: "nd", 3: "rd"}.get(n % 10, "th")
+        return "%d%s" % (n, suffix)
+
+def describe(counter, threshold):
+        parts = counter.split(":", 2)
+        what = "%s %s" % (ordinal(threshold), parts[1])
+        if parts[0] == "repo":
+                return "the %s to %s" % (what, parts[2].split("/")[-1])
+        if parts[0] == "author":
+                return "their %s tonight" % what
+        return "the %s tonight" % what
+
+def _claim(counter, threshold, author_name, author_email):
+        key_name = "%s|%d" % (counter, threshold)
+        if Milestone.get_by_key_name(key_name) is not None:
+                return
+        Milestone(key_name=key_name, counter=counter, threshold=threshold,
+                        author_name=author_name, author_email=author_email).put()
+        taskqueue.add(url="/awards", params={"milestone": key_name},
+                        transactional=True)
+
+# Checks an increment of counter from old to new for crossed milestones.
+# contributions lists (commit, amount) in push order so a jump over a
+# threshold can still be pinned on the commit that crossed it.
+def check(counter, old, new, contributions):
+        kind = ":".join(counter.split(":", 2)[:2])
+        for threshold in MILESTONES.get(kind, []):
+                if not old < threshold <= new:
+                        continue
+                winner = None
+                total = old
+                for commit, amount in contributions:
+                        total += amount
+                        winner = commit
+                        if total >= threshold:
+                                break
+                if winner is None:
+                        continue
+                db.run_in_transaction(_claim, counter, threshold,
+                                winner["author_name"], winner["author_email"])
+
+def _mark_sent(key_name, sent):
+        milestone = Milestone.get_by_key_name(key_name)
+        if milestone is None or milestone.sent == sent:
+                return None
+        milestone.sent = sent
+        milestone.put()
+        return milestone
+
+def send(key_name):
+        # Marking the milestone first means a retried task can't mail twice;
+        # the mark is rolled back if the mail itself fails.
+        milestone = db.run_in_transaction(_mark_sent, key_name, True)
+        if milestone is None:
+                return
+        description = describe(milestone.counter, milestone.threshold)
+        try:
+                mail.send_mail_to_admins(ADMIN_EMAIL,
+                                "%s milestone: %s" % (EVENT_NAME, description),
+                                "%s (%s) deserves a prize for %s." % (
+                                        milestone.author_name,
+                                        milestone.author_email, description))
+        except:
+                db.run_in_transaction(_mark_sent, key_name, False)
+                raise
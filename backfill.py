@@ -0,0 +1,209 @@
+from google.appengine.api import taskqueue
+from google.appengine.ext import db
+from django.utils import simplejson
+from datetime import datetime
+import logging
+import counters
+
+# A backfill recounts the metric counters from the stored commits. The
+# commit key space is split into SHARDS ranges that are walked in parallel
+# task chains, BATCH commits per task, each keeping its partial counts on
+# its own BackfillShard. Once every shard is done the partials are merged
+# and the difference from the counters' totals when the job started is
+# applied to the counters, so live increments made meanwhile are kept.
+SHARDS = 16
+BATCH = 250
+
+# The stored model and a function(entities, started) returning the
+# (counter name -> count, extra fields) tally of one batch.
+SOURCE = {}
+
+class BackfillJob(db.Model):
+        shards = db.IntegerProperty(required=True)
+        finished_shards = db.ListProperty(int)
+        baseline = db.TextProperty()
+        status = db.StringProperty(default="running") # running, merging or done
+        started = db.DateTimeProperty(auto_now_add=True)
+        finished = db.DateTimeProperty()
+
+class BackfillShard(db.Model):
+        step = db.IntegerProperty(default=0)
+        cursor = db.TextProperty()
+        processed = db.IntegerProperty(default=0)
+        counts = db.TextProperty(default="{}")
+        fields = db.TextProperty(default="{}")
+        done = db.BooleanProperty(default=False)
+        last_update = db.DateTimeProperty(auto_now=True)
+
+def register(model, tally):
+        SOURCE["model"] = model
+        SOURCE["tally"] = tally
+
+def shard_name(job_name, index):
+        return "%s:%d" % (job_name, index)
+
+# Key names are "sha:" plus a hex SHA, so evenly spaced hex prefixes split
+# them evenly. Keys before the first prefix, such as numeric ids, fall in
+# the first shard.
+def key_range(shards, index):
+        def bound(i):
+                if i <= 0 or i >= shards:
+                        return None
+                return db.Key.from_path(SOURCE["model"].kind(),
+                                "sha:%04x" % (i * 0x10000 // shards))
+        return bound(index), bound(index + 1)
+
+def _query(shards, index):
+        query = SOURCE["model"].all().order("__key__")
+        lower, upper = key_range(shards, index)
+        if lower is not None:
+                query.filter("__key__ >=", lower)
+        if upper is not None:
+                query.filter("__key__ <", upper)
+        return query
+
+def _shard_task(job_name, index, step):
+        return taskqueue.Task(url="/backfill/shard", params={
+                "job": job_name, "shard": index, "step": step})
+
+def start(shards=SHARDS):
+        job_name = "backfill-%s" % datetime.utcnow().strftime("%Y%m%d%H%M%S")
+        # The baseline is read before "started" is set, so a commit counted
+        # after it started can't be in the baseline; only increments still in
+        # flight while it is read can be counted twice.
+        baseline = simplejson.dumps(counters.all_counts())
+        job = BackfillJob(key_name=job_name, shards=shards, baseline=baseline,
+                        started=datetime.utcnow())
+        job.put()
+        db.put([BackfillShard(key_name=shard_name(job_name, index))
+                        for index in range(shards)])
+        taskqueue.Queue().add([_shard_task(job_name, index, 0)
+                        for index in range(shards)])
+        return job_name
+
+def _save_shard(shard, step, next_task):
+        stored = BackfillShard.get(shard.key())
+        if stored.step != step:
+                return False
+        shard.put()
+        if next_task is not None:
+                taskqueue.Queue().add(next_task, transactional=True)
+        return True
+
+def _finish_shard(job_name, index):
+        job = BackfillJob.get_by_key_name(job_name)
+        if index in job.finished_shards:
+                return
+        job.finished_shards.append(index)
+        if len(job.finished_shards) == job.shards:
+                job.status = "merging"
+                taskqueue.add(url="/backfill/merge", params={"job": job_name},
+                                transactional=True)
+        job.put()
+
+def _merge_into(totals, partial):
+        for name, count in partial.items():
+                totals[name] = totals.get(name, 0) + count
+
+def run_shard(job_name, index, step):
+        job = BackfillJob.get_by_key_name(job_name)
+        shard = BackfillShard.get_by_key_name(shard_name(job_name, index))
+        if job is None or shard is None:
+                return
+        if shard.done:
+                db.run_in_transaction(_finish_shard, job_name, index)
+                return
+        if shard.step != step:
+                # A redelivered task whose batch was already saved.
+                return
+        query = _query(job.shards, index)
+        if shard.cursor:
+                query.with_cursor(shard.cursor)
+        entities = query.fetch(BATCH)
+        counts, fields = SOURCE["tally"](entities, job.started)
+        partial = simplejson.loads(shard.counts)
+        _merge_into(partial, counts)
+        shard.counts = simplejson.dumps(partial)
+        merged = simplejson.loads(shard.fields)
+        merged.update(fields)
+        shard.fields = simplejson.dumps(merged)
+        shard.processed += len(entities)
+        shard.step = step + 1
+        next_task = None
+        if len(entities) == BATCH:
+                shard.cursor = query.cursor()
+                next_task = _shard_task(job_name, index, step + 1)
+        else:
+                shard.done = True
+        if db.run_in_transaction(_save_shard, shard, step, next_task) and shard.done:
+                db.run_in_transaction(_finish_shard, job_name, index)
+
+def _mark_done(job_name):
+        job = BackfillJob.get_by_key_name(job_name)
+        if job.status == "done":
+                return False
+        job.status = "done"
+        job.finished = datetime.utcnow()
+        job.put()
+        return True
+
+# Merges the shards' partial counts and moves each counter by the difference
+# between its recount and its total when the job started. Returns the
+# recounted names and the merged extra fields, or None if the job was
+# already merged. A merge that dies part way is repaired by the next
+# backfill, since that one measures from its own baseline.
+def merge(job_name):
+        job = BackfillJob.get_by_key_name(job_name)
+        if job is None or job.status != "merging":
+                return None
+        totals = {}
+        fields = {}
+        shards = BackfillShard.get_by_key_name([shard_name(job_name, index)
+                        for index in range(job.shards)])
+        for shard in shards:
+                _merge_into(totals, simplejson.loads(shard.counts))
+                fields.update(simplejson.loads(shard.fields))
+        baseline = simplejson.loads(job.baseline)
+        # A counter too new for the baseline's name query can't be measured
+        # against it, so it keeps its live total.
+        unmeasured = [name for name in totals if name not in baseline]
+        if unmeasured:
+                logging.warning("%s left %d counters missing from its baseline: %s",
+                                job_name, len(unmeasured), ", ".join(unmeasured[:20]))
+        names = set(baseline.keys())
+        if not db.run_in_transaction(_mark_done, job_name):
+                return None
+        counters.adjust(dict([(name, totals.get(name, 0) - baseline.get(name, 0))
+                        for name in names]))
+        logging.info("%s merged %d commits into %d counters", job_name,
+                        sum([shard.processed for shard in shards]), len(names))
+        return list(names), fields
+
+def progress(job_name):
+        job = BackfillJob.get_by_key_name(job_name)
+        if job is None:
+                return None
+        shards = BackfillShard.get_by_key_name([shard_name(job_name, index)
+                        for index in range(job.shards)])
+        processed = sum([shard.processed for shard in shards if shard is not None])
+        end = job.finished or datetime.utcnow()
+        elapsed = end - job.started
+        seconds = elapsed.days * 86400 + elapsed.seconds + elapsed.microseconds / 1e6
+        report = {
+                "job": job_name,
+                "status": job.status,
+                "shards": job.shards,
+                "finished_shards": len(job.finished_shards),
+                "processed": processed,
+                "seconds": round(seconds, 1),
+                "commits_per_second": 0
+        }
+        if seconds:
+                report["commits_per_second"] = round(processed / seconds, 1)
+        return report
+
+def latest():
+        job = BackfillJob.all().order("-started").get()
+        if job is None:
+                return None
+        return progress(job.key().name())
@@ -0,0 +1,249 @@
+"""Replay webhook traffic through GitWatch in-process and report what it cost.
+
+The WSGI application runs against the App Engine testbed stubs, so this needs
+the SDK on the path::
+
+    python benchmarks/loadtest.py --sdk ~/google_appengine --pushes 200 \\
+            --commits 20 --rate 0 --page-loads 50
+
+Each run replays testpayload and dirtytestpayload.json, then the synthetic
+pushes, draining the task queue through /metric, /pusher, /fanout, /awards
+and the other workers after every push. Per handler it reports requests,
+errors, p50/p99 latency and the datastore, memcache, taskqueue, channel and
+mail RPCs it made (printed per request). The RPC counts don't depend on
+timing, so they are the numbers to compare between commits; --json writes
+everything out for diffing.
+"""
+import base64
+import cgi
+import hashlib
+import optparse
+import os
+import random
+import sys
+import time
+import urllib
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+AUTHORS = ["ada", "brian", "carol", "dennis", "edsger", "grace", "ken",
+        "linus", "margaret", "niklaus", "radia", "tim"]
+MESSAGES = ["Fix the build", "Merge branch 'master'", "Add tests for the parser",
+        "damn typo", "Refactor everything", "What the hell was I thinking",
+        "Update README", "shit, forgot a file"]
+
+def setup_sdk(sdk):
+        if sdk:
+                sys.path.insert(0, sdk)
+        try:
+                import dev_appserver
+        except ImportError:
+                sys.exit("The App Engine SDK wasn't found; pass its directory "
+                                "with --sdk.")
+        dev_appserver.fix_sys_path()
+        sys.path.insert(0, ROOT)
+
+class RPCStats(object):
+        def __init__(self):
+                self.handler = None
+                self.started = {}
+                self.calls = {}
+
+        # Keyed by the rpc, like stats.py, so overlapping calls are paired
+        # correctly.
+        def pre_call(self, service, call, request, response, rpc):
+                self.started[rpc] = time.time()
+
+        def post_call(self, service, call, request, response, rpc, error):
+                started = self.started.pop(rpc, None)
+                if started is None:
+                        return
+                elapsed = time.time() - started
+                key = (self.handler, service)
+                count, total = self.calls.get(key, (0, 0.0))
+                self.calls[key] = (count + 1, total + elapsed)
+
+class Harness(object):
+        def __init__(self):
+                from google.appengine.api import apiproxy_stub_map
+                from google.appengine.ext import testbed
+
+                os.chdir(ROOT)
+                self.testbed = testbed.Testbed()
+                self.testbed.activate()
+                self.testbed.setup_env(app_id="gitwatch")
+                self.testbed.init_datastore_v3_stub()
+                self.testbed.init_memcache_stub()
+                self.testbed.init_taskqueue_stub(root_path=ROOT)
+                self.testbed.init_channel_stub()
+                self.testbed.init_mail_stub()
+                self.taskqueue = self.testbed.get_stub(testbed.TASKQUEUE_SERVICE_NAME)
+
+                self.rpcs = RPCStats()
+                apiproxy_stub_map.apiproxy.GetPreCallHooks().Append(
+                                "loadtest", self.rpcs.pre_call)
+                apiproxy_stub_map.apiproxy.GetPostCallHooks().Append(
+                                "loadtest", self.rpcs.post_call)
+
+                import main
+                self.application = main.application
+                self.latencies = {}
+                self.errors = {}
+
+        def request(self, method, path, body=None, headers=None):
+                import webob
+
+                environ = {"REMOTE_ADDR": "127.0.0.1"}
+                request = webob.Request.blank(path, environ=environ,
+                                headers=headers or {})
+                request.method = method
+                if body is not None:
+                        request.body = body
+                        request.content_type = "application/x-www-form-urlencoded"
+                handler = path.split("?")[0]
+                if handler.startswith("/approve/"):
+                        handler = "/approve"
+                self.rpcs.handler = handler
+                start = time.time()
+                response = request.get_response(self.application)
+                self.latencies.setdefault(handler, []).append(time.time() - start)
+                if response.status_int >= 400:
+                        self.errors[handler] = self.errors.get(handler, 0) + 1
+                self.rpcs.handler = None
+                return response
+
+        def push(self, body):
+                self.request("POST", "/github", body)
+                self.drain()
+
+        def drain(self):
+                while True:
+                        tasks = self.taskqueue.GetTasks("default")
+                        if not tasks:
+                                return
+                        tasks.sort(key=lambda task: task["eta"])
+                        for task in tasks:
+                                self.taskqueue.DeleteTask("default", task["name"])
+                                self.request(task["method"], task["url"],
+                                                base64.b64decode(task["body"]),
+                                                {"X-AppEngine-QueueName": "default"})
+
+        def report(self):
+                services = {}
+                for (handler, service), (count, total) in self.rpcs.calls.items():
+                        services.setdefault(handler, {})[service] = {
+                                "calls": count, "ms": round(total * 1000, 2)}
+                handlers = {}
+                for handler, latencies in self.latencies.items():
+                        latencies = sorted(latencies)
+                        handlers[handler] = {
+                                "requests": len(latencies),
+                                "errors": self.errors.get(handler, 0),
+                                "p50_ms": round(percentile(latencies, 0.5) * 1000, 2),
+                                "p99_ms": round(percentile(latencies, 0.99) * 1000, 2),
+                                "rpcs": services.get(handler, {})
+                        }
+                return handlers
+
+def percentile(values, fraction):
+        if not values:
+                return 0.0
+        return values[int(round(fraction * (len(values) - 1)))]
+
+def payload_body(payload):
+        from django.utils import simplejson
+        return urllib.urlencode({"payload": simplejson.dumps(payload)})
+
+def synthetic_push(index, commits, repos):
+        repo = "https://github.com/hackathon/project-%d" % (index % repos)
+        author_pool = random.sample(AUTHORS, min(3, len(AUTHORS)))
+        entries = []
+        for i in range(commits):
+                author = random.choice(author_pool)
+                sha = hashlib.sha1("%d-%d" % (index, i)).hexdigest()
+                entries.append({
+                        "id": sha,
+                        "url": "%s/commit/%s" % (repo, sha),
+                        "author": {"name": author.title(),
+                                "email": "%s@example.com" % author},
+                        "message": random.choice(MESSAGES),
+                        "timestamp": "2012-03-22T11:%02d:%02d-07:00" % (i % 60, index % 60),
+                        "added": ["file%d.py" % i]
+                })
+        return {
+                "pusher": {"name": author_pool[0]},
+                "repository": {
+                        "url": repo,
+                        "name": repo.split("/")[-1],
+                        "owner": {"name": "hackathon", "email": "team@example.com"}
+                },
+                "commits": entries
+        }
+
+def main():
+        parser = optparse.OptionParser()
+        parser.add_option("--sdk", help="path to the App Engine SDK")
+        parser.add_option("--pushes", type="int", default=100)
+        parser.add_option("--commits", type="int", default=10,
+                        help="commits per synthetic push")
+        parser.add_option("--repos", type="int", default=10)
+        parser.add_option("--rate", type="float", default=0,
+                        help="pushes per second, 0 for as fast as possible")
+        parser.add_option("--page-loads", type="int", default=10,
+                        help="MainPage loads spread across the run")
+        parser.add_option("--seed", type="int", default=0)
+        parser.add_option("--json", help="also write the report to this file")
+        options, args = parser.parse_args()
+
+        setup_sdk(options.sdk)
+        from django.utils import simplejson
+
+        random.seed(options.seed)
+        harness = Harness()
+
+        replayed = cgi.parse_qs(open(os.path.join(ROOT, "testpayload")).read())
+        harness.push(urllib.urlencode({"payload": replayed["payload"][0]}))
+        dirty = open(os.path.join(ROOT, "dirtytestpayload.json")).read()
+        harness.push(urllib.urlencode({"payload": dirty}))
+
+        page_every = 0
+        if options.page_loads:
+                page_every = max(options.pushes / options.page_loads, 1)
+        start = time.time()
+        for index in range(options.pushes):
+                harness.push(payload_body(synthetic_push(index, options.commits,
+                                options.repos)))
+                if page_every and index % page_every == 0:
+                        harness.request("GET", "/")
+                if options.rate:
+                        delay = start + (index + 1) / options.rate - time.time()
+                        if delay > 0:
+                                time.sleep(delay)
+        elapsed = time.time() - start
+
+        handlers = harness.report()
+        commits = options.pushes * options.commits
+        report = {
+                "pushes": options.pushes,
+                "commits": commits,
+                "seconds": round(elapsed, 3),
+                "commits_per_second": round(commits / elapsed, 2),
+                "handlers": handlers
+        }
+        print("%d pushes, %d commits in %.2fs (%.1f commits/s)" % (
+                options.pushes, commits, elapsed, commits / elapsed))
+        for handler in sorted(handlers):
+                stats = handlers[handler]
+                rpcs = ", ".join(["%s=%.1f" % (service,
+                        stats["rpcs"][service]["calls"] / float(stats["requests"]))
+                        for service in sorted(stats["rpcs"])])
+                print("%-16s n=%-6d err=%-4d p50=%8.2fms p99=%8.2fms  %s" % (
+                        handler, stats["requests"], stats["errors"],
+                        stats["p50_ms"], stats["p99_ms"], rpcs))
+        if options.json:
+                out = open(options.json, "w")
+                out.write(simplejson.dumps(report, indent=2))
+                out.close()
+
+if __name__ == "__main__":
+        main()
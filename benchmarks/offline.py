@@ -0,0 +1,80 @@
+"""Run the webhook-to-dashboard pipeline against a storage backend and time it.
+
+The SQLite backend needs nothing beyond the standard library::
+
+    python benchmarks/offline.py --db gitwatch.db --pushes 500 --commits 20
+
+The datastore backend runs the same pipeline on the App Engine testbed, so
+the two can be compared on one box::
+
+    python benchmarks/offline.py --backend datastore --sdk ~/google_appengine
+
+Each run replays testpayload and dirtytestpayload.json, then the synthetic
+pushes from loadtest.py, counting every push as it arrives, and prints the
+ingest rate and the dashboard the run ends with.
+"""
+import cgi
+import optparse
+import os
+import random
+import sys
+import time
+
+import loadtest
+
+sys.path.insert(0, loadtest.ROOT)
+
+def open_storage(options):
+        if options.backend == "datastore":
+                loadtest.setup_sdk(options.sdk)
+                loadtest.Harness()
+                import main
+                return main.STORAGE
+        import storage
+        return storage.SQLiteStorage(options.db, auto_approve=True)
+
+def main():
+        parser = optparse.OptionParser()
+        parser.add_option("--backend", default="sqlite",
+                        help="sqlite or datastore")
+        parser.add_option("--db", default="gitwatch.db",
+                        help="SQLite database file")
+        parser.add_option("--sdk", help="path to the App Engine SDK")
+        parser.add_option("--pushes", type="int", default=100)
+        parser.add_option("--commits", type="int", default=10,
+                        help="commits per synthetic push")
+        parser.add_option("--repos", type="int", default=10)
+        parser.add_option("--seed", type="int", default=0)
+        options, args = parser.parse_args()
+
+        store = open_storage(options)
+        import pipeline
+        import storage
+
+        random.seed(options.seed)
+        replayed = cgi.parse_qs(open(os.path.join(loadtest.ROOT, "testpayload")).read())
+        bodies = [replayed["payload"][0],
+                open(os.path.join(loadtest.ROOT, "dirtytestpayload.json")).read()]
+        for index in range(options.pushes):
+                bodies.append(storage.simplejson.dumps(loadtest.synthetic_push(index,
+                                options.commits, options.repos)))
+
+        start = time.time()
+        commits = 0
+        for body in bodies:
+                commits += len(pipeline.push(store, body))
+        store.flush()
+        elapsed = time.time() - start
+
+        dashboard = pipeline.dashboard(store)
+        print("%s: %d pushes, %d new commits in %.2fs (%.1f commits/s)" % (
+                options.backend, len(bodies), commits, elapsed,
+                commits / max(elapsed, 1e-6)))
+        print("global: %d commits, %d curses" % (dashboard["global_commits"],
+                dashboard["global_curses"]))
+        for board in ("authors_desc", "repos_desc", "curse_authors_desc"):
+                print("%s: %s" % (board, ", ".join(["%s=%d" % (entry["name"],
+                        entry["count"]) for entry in dashboard[board]])))
+
+if __name__ == "__main__":
+        main()
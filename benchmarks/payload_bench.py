@@ -0,0 +1,84 @@
+"""Compare payload.decode_push against the decoding HookReceiver used to do.
+
+Run with ``python benchmarks/payload_bench.py [commits] [repeat]``. It needs
+``django.utils.simplejson`` importable, e.g. with the SDK's lib/django on the
+path.
+"""
+from datetime import datetime, timedelta
+import hashlib
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from django.utils import simplejson
+import payload
+
+AUTHORS = ["ada", "brian", "carol", "dennis"]
+
+def old_commit(json):
+        for key in ("id", "url", "author"):
+                if key not in json:
+                        raise payload.MissingParamException(key)
+        for key in ("email", "name"):
+                if key not in json["author"]:
+                        raise payload.MissingParamException("author." + key)
+        hashlib.md5(json["author"]["email"].strip().lower()).hexdigest()
+        if "timestamp" in json:
+                offset = None
+                if json["timestamp"].rindex("-") > json["timestamp"].index("T"):
+                        offset = ("-", json["timestamp"].rsplit("-", 1)[-1])
+                        json["timestamp"] = json["timestamp"].rsplit("-", 1)[0]
+                if "+" in json["timestamp"]:
+                        offset = ("+", json["timestamp"].split("+")[-1])
+                        json["timestamp"] = json["timestamp"].split("+")[0]
+                timestamp = datetime.strptime(json["timestamp"], "%Y-%m-%dT%H:%M:%S")
+                hours = int(offset[1].split(":")[0])
+                minutes = int(offset[1].split(":")[1])
+                if offset[0] == "+":
+                        timestamp = timestamp + timedelta(hours=hours, minutes=minutes)
+                else:
+                        timestamp = timestamp - timedelta(minutes=minutes, hours=hours)
+
+def old_decode(text):
+        body = simplejson.loads(text)
+        for commit in body["commits"]:
+                commit["pusher"] = body["pusher"]
+                old_commit(commit)
+
+def make_push(commits):
+        entries = []
+        for i in range(commits):
+                author = AUTHORS[i % len(AUTHORS)]
+                entries.append({
+                        "id": hashlib.sha1(str(i)).hexdigest(),
+                        "url": "https://github.com/hackathon/project/commit/%d" % i,
+                        "author": {"name": author, "email": "%s@example.com" % author},
+                        "timestamp": "2012-03-22T11:%02d:%02d-07:00" % (i % 60, i % 60),
+                        "message": "Commit number %d" % i
+                })
+        return simplejson.dumps({
+                "pusher": {"name": "ada"},
+                "repository": {"url": "https://github.com/hackathon/project",
+                        "owner": {"name": "hackathon", "email": "team@example.com"}},
+                "commits": entries
+        })
+
+def main():
+        commits = 100
+        repeat = 50
+        if len(sys.argv) > 1:
+                commits = int(sys.argv[1])
+        if len(sys.argv) > 2:
+                repeat = int(sys.argv[2])
+        text = make_push(commits)
+        old = min(timeit.repeat(lambda: old_decode(text), number=1, repeat=repeat))
+        new = min(timeit.repeat(lambda: payload.decode_push(text), number=1,
+                        repeat=repeat))
+        print("push of %d commits, %d bytes" % (commits, len(text)))
+        print("old decoding:        %.2f ms" % (old * 1000))
+        print("payload.decode_push: %.2f ms" % (new * 1000))
+        print("speedup:             %.2fx" % (old / new))
+
+if __name__ == "__main__":
+        main()
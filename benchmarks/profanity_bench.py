@@ -0,0 +1,51 @@
+"""Compare the curse detector against the regex MetricWorker used to build.
+
+Run with ``python benchmarks/profanity_bench.py [message_kb] [repeat]``; it
+only needs the standard library.
+"""
+import os
+import random
+import re
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+import profanity
+
+OLD_PATTERN = "[^\w]ass[^\w]|[^\w]asshole[^\w]|[^\w]dumbass[^\w]|[^\w]hell[^\w]|fuck|shit|damn|bitch|bastard"
+WORDS = ["fix", "merge", "branch", "the", "build", "again", "tests", "hello",
+        "classy", "shell", "refactor", "damn", "shit", "asshole", "hell"]
+
+def old_count(message):
+        r = re.compile(OLD_PATTERN, flags=re.IGNORECASE)
+        return len(r.findall(message))
+
+def make_message(size):
+        words = []
+        length = 0
+        while length < size:
+                word = random.choice(WORDS)
+                words.append(word)
+                length += len(word) + 1
+        return u" ".join(words)
+
+def main():
+        size = 1024 * 64
+        repeat = 20
+        if len(sys.argv) > 1:
+                size = int(sys.argv[1]) * 1024
+        if len(sys.argv) > 2:
+                repeat = int(sys.argv[2])
+        random.seed(0)
+        messages = [make_message(size) for i in range(20)]
+        old = min(timeit.repeat(lambda: [old_count(m) for m in messages],
+                        number=1, repeat=repeat))
+        new = min(timeit.repeat(lambda: profanity.score(messages),
+                        number=1, repeat=repeat))
+        print("%d messages of %d KB" % (len(messages), size / 1024))
+        print("regex per commit:  %.2f ms" % (old * 1000))
+        print("profanity.score:   %.2f ms" % (new * 1000))
+        print("speedup:           %.2fx" % (old / new))
+
+if __name__ == "__main__":
+        main()
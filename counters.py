@@ -0,0 +1,164 @@
+from google.appengine.api import memcache
+from google.appengine.ext import db
+import random
+
+# Number of shards a new increment may land on, by counter prefix. The global
+# counters are touched by every commit, so they get the most shards.
+SHARDS = {
+        "global": 20,
+        "repo": 5,
+        "author": 3,
+}
+DEFAULT_SHARDS = 5
+GET_BATCH = 500
+# Counters applied per batch transaction; with the batch itself that keeps
+# each transaction within five entity groups.
+BATCH_GROUPS = 4
+# Cached totals expire so a racing read/increment can only drift briefly.
+CACHE_TIME = 60
+
+class CounterShard(db.Model):
+        name = db.StringProperty(required=True)
+        count = db.IntegerProperty(required=True, default=0)
+
+# Records which counters a named batch of increments has applied, so a batch
+# retried after a failure adds each delta once.
+class CounterBatch(db.Model):
+        applied = db.StringListProperty(indexed=False)
+        done = db.BooleanProperty(default=False, indexed=False)
+        created = db.DateTimeProperty(auto_now_add=True)
+
+def counter_name(*parts):
+        return ":".join(parts)
+
+def num_shards(name):
+        return SHARDS.get(name.split(":", 1)[0], DEFAULT_SHARDS)
+
+def _cache_key(name):
+        return "counter:" + name
+
+def shard_names(name):
+        return ["%s-%d" % (name, index) for index in range(num_shards(name))]
+
+# Sums shards by key, which unlike a query on "name" is strongly consistent.
+def _sum_shards(names):
+        key_names = []
+        for name in names:
+                key_names.extend(shard_names(name))
+        totals = dict([(name, 0) for name in names])
+        for start in range(0, len(key_names), GET_BATCH):
+                for shard in CounterShard.get_by_key_name(key_names[start:start + GET_BATCH]):
+                        if shard is not None:
+                                totals[shard.name] += shard.count
+        return totals
+
+def get_count(name):
+        total = memcache.get(_cache_key(name))
+        if total is None:
+                total = _sum_shards([name])[name]
+                memcache.add(_cache_key(name), total, time=CACHE_TIME)
+        return total
+
+def get_counts(names):
+        cached = memcache.get_multi(names, key_prefix="counter:")
+        missing = _sum_shards([name for name in names if name not in cached])
+        if missing:
+                cached.update(missing)
+                memcache.add_multi(missing, time=CACHE_TIME,
+                                key_prefix="counter:")
+        return cached
+
+def _increment_shard(shard_name, name, delta):
+        shard = CounterShard.get_by_key_name(shard_name)
+        if shard is None:
+                shard = CounterShard(key_name=shard_name, name=name)
+        shard.count += delta
+        shard.put()
+
+# Adds delta to the counter's first shard within the caller's transaction,
+# e.g. to carry a count over from elsewhere atomically. The cached total is
+# not touched; pass the same deltas to offset_cached once it commits.
+def seed(name, delta):
+        _increment_shard(shard_names(name)[0], name, delta)
+
+def offset_cached(deltas):
+        memcache.offset_multi(deltas, key_prefix="counter:")
+
+# Returns the new total, or None if delta is zero.
+def increment(name, delta=1):
+        if not delta:
+                return None
+        shard_name = random.choice(shard_names(name))
+        db.run_in_transaction(_increment_shard, shard_name, name, delta)
+        total = memcache.incr(_cache_key(name), delta)
+        if total is None:
+                # incr is a no-op on a cold key, so re-sum the shards.
+                total = get_count(name)
+        return total
+
+def _apply_batch(batch_name, deltas):
+        batch = CounterBatch.get_by_key_name(batch_name)
+        if batch is None:
+                batch = CounterBatch(key_name=batch_name)
+        applied = []
+        for name, delta in deltas:
+                if name in batch.applied:
+                        continue
+                _increment_shard(random.choice(shard_names(name)), name, delta)
+                batch.applied.append(name)
+                applied.append((name, delta))
+        batch.put()
+        return applied
+
+# Adds a name -> delta map like increment, but each delta at most once per
+# batch_name: a shard and the batch's record of it are written in the same
+# transaction. Returns the totals and the names this call added.
+def increment_batch(batch_name, deltas):
+        pending = [(name, delta) for name, delta in sorted(deltas.items()) if delta]
+        options = db.create_transaction_options(xg=True)
+        applied = []
+        for start in range(0, len(pending), BATCH_GROUPS):
+                applied.extend(db.run_in_transaction_options(options, _apply_batch,
+                                batch_name, pending[start:start + BATCH_GROUPS]))
+        totals = {}
+        for name, delta in applied:
+                total = memcache.incr(_cache_key(name), delta)
+                if total is not None:
+                        totals[name] = total
+        missing = [name for name in deltas if name not in totals]
+        if missing:
+                totals.update(get_counts(missing))
+        return totals, [name for name, delta in applied]
+
+def _finish_batch(batch_name):
+        batch = CounterBatch.get_by_key_name(batch_name)
+        if batch is None:
+                batch = CounterBatch(key_name=batch_name)
+        batch.done = True
+        batch.put()
+
+def finish_batch(batch_name):
+        db.run_in_transaction(_finish_batch, batch_name)
+
+def batch_done(batch_name):
+        batch = CounterBatch.get_by_key_name(batch_name)
+        return batch is not None and batch.done
+
+# Totals of every counter, summed straight from the shards. Only finding the
+# names takes a query; the counts are read by key, so they are strongly
+# consistent as of the call.
+def all_counts():
+        names = set()
+        for key in CounterShard.all(keys_only=True):
+                names.add(key.name().rsplit("-", 1)[0])
+        return _sum_shards(list(names))
+
+# Applies name -> delta corrections, which may be negative. Cached totals are
+# offset in place; uncached ones are re-summed on their next read.
+def adjust(deltas):
+        deltas = dict([(name, delta) for name, delta in deltas.items() if delta])
+        for name, delta in deltas.items():
+                db.run_in_transaction(_increment_shard,
+                                random.choice(shard_names(name)), name, delta)
+        if deltas:
+                offset_cached(deltas)
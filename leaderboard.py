@@ -0,0 +1,146 @@
+from google.appengine.api import memcache
+from google.appengine.ext import db
+from django.utils import simplejson
+import bisect
+import logging
+import time
+
+# Boards live in memcache as a sorted (count, key) list plus a key -> count
+# map, so an update is a bisect and a list insert instead of an ordered query.
+BOARD_SIZE = 10
+CHECKPOINT_INTERVAL = 30
+RETRIES = 5
+# Only the ends of a board are shown, so past MAX_ENTRIES the middle of the
+# order is dropped to keep the board well under memcache's 1MB value limit
+# (and the checkpoint's). A dropped key comes back with its next update, but
+# one that is never updated again stays out, so the ascending board can miss
+# it once the entries kept below it have climbed past it; reset() rebuilds
+# the board from the metric rows.
+MAX_ENTRIES = 1000
+
+# name -> function returning [(key, fields, count), ...] from the metric rows,
+# used when a board has neither a cached copy nor a checkpoint.
+SOURCES = {}
+
+class LeaderboardCheckpoint(db.Model):
+        data = db.TextProperty()
+        last_update = db.DateTimeProperty(auto_now=True)
+
+def register(name, source):
+        SOURCES[name] = source
+
+def _new_board():
+        return {"counts": {}, "fields": {}, "order": [], "checkpointed": 0}
+
+def _apply(board, entries):
+        for key, fields, count in entries:
+                if not count:
+                        continue
+                board["fields"][key] = fields
+                old = board["counts"].get(key)
+                if old is not None:
+                        if count <= old:
+                                continue
+                        del board["order"][bisect.bisect_left(board["order"], (old, key))]
+                bisect.insort(board["order"], (count, key))
+                board["counts"][key] = count
+        _trim(board)
+
+def _trim(board):
+        excess = len(board["order"]) - MAX_ENTRIES
+        if excess <= 0:
+                return
+        middle = MAX_ENTRIES // 2
+        for count, key in board["order"][middle:middle + excess]:
+                del board["counts"][key]
+                del board["fields"][key]
+        del board["order"][middle:middle + excess]
+
+def _load(name):
+        board = _new_board()
+        checkpoint = LeaderboardCheckpoint.get_by_key_name(name)
+        if checkpoint is not None:
+                _apply(board, simplejson.loads(checkpoint.data))
+                board["checkpointed"] = time.time()
+        elif name in SOURCES:
+                _apply(board, SOURCES[name]())
+        return board
+
+def _checkpoint(boards):
+        checkpoints = []
+        for name, board in boards.items():
+                entries = []
+                for count, key in board["order"]:
+                        entries.append((key, board["fields"][key], count))
+                checkpoints.append(LeaderboardCheckpoint(key_name=name,
+                                data=simplejson.dumps(entries)))
+        db.put(checkpoints)
+
+def update(updates):
+        client = memcache.Client()
+        pending = updates
+        for attempt in range(RETRIES):
+                boards = client.get_multi(pending.keys(), key_prefix="leaderboard:",
+                                for_cas=True)
+                now = time.time()
+                missing = {}
+                for name in pending:
+                        if name not in boards:
+                                missing[name] = _load(name)
+                                _apply(missing[name], pending[name])
+                for name in boards:
+                        _apply(boards[name], pending[name])
+                        if now - boards[name]["checkpointed"] > CHECKPOINT_INTERVAL:
+                                boards[name]["checkpointed"] = now
+                failed = []
+                if missing:
+                        failed.extend(client.add_multi(missing, key_prefix="leaderboard:"))
+                if boards:
+                        failed.extend(client.cas_multi(boards, key_prefix="leaderboard:"))
+                # Only the writer that moved "checkpointed" forward persists it.
+                due = {}
+                for name in boards:
+                        if name not in failed and boards[name]["checkpointed"] == now:
+                                due[name] = boards[name]
+                if due:
+                        _checkpoint(due)
+                if not failed:
+                        return
+                retry = {}
+                for name in failed:
+                        retry[name] = pending[name]
+                pending = retry
+        logging.error("Leaderboard updates to %s dropped after %d attempts",
+                        ", ".join(sorted(pending.keys())), RETRIES)
+
+# Drops the cached boards and their checkpoints so they are reloaded from the
+# metric rows, e.g. after the counts were recomputed and some went down.
+def reset(names):
+        memcache.delete_multi(names, key_prefix="leaderboard:")
+        db.delete([db.Key.from_path("LeaderboardCheckpoint", name)
+                        for name in names])
+
+def _ranked(board, keys):
+        ranked = []
+        for count, key in keys:
+                entry = dict(board["fields"][key])
+                entry["count"] = count
+                ranked.append(entry)
+        return ranked
+
+def get_boards(names):
+        boards = memcache.get_multi(names, key_prefix="leaderboard:")
+        missing = {}
+        for name in names:
+                if name not in boards:
+                        boards[name] = missing[name] = _load(name)
+        if missing:
+                memcache.add_multi(missing, key_prefix="leaderboard:")
+        ranked = {}
+        for name in names:
+                order = boards[name]["order"]
+                top = order[-BOARD_SIZE:]
+                top.reverse()
+                ranked[name] = {"desc": _ranked(boards[name], top),
+                                "asc": _ranked(boards[name], order[:BOARD_SIZE])}
+        return ranked
@@ -1,5 +1,4 @@
 from google.appengine.api import channel
-from google.appengine.api import mail
 from google.appengine.api import memcache
 from google.appengine.api import taskqueue
 from google.appengine.api import users
@@ -9,20 +8,22 @@ from google.appengine.ext.webapp import template
 from google.appengine.ext.webapp.util import run_wsgi_app
 from django.utils import simplejson
 import time
-from datetime import datetime, timedelta
-import logging
-import re
+from datetime import datetime
 import hashlib
-import unicodedata
-
-class MissingParamException(Exception):
-        param = None
-
-        def __init__(self, param):
-                self.param = param
-
-        def __str__(self):
-                return ("MissingParamException: %s", self.param)
+import logging
+import sys
+import awards
+import backfill
+import counters
+import leaderboard
+import payload
+import pipeline
+import profanity
+import protocol
+import rollups
+import stats
+import storage
+import subscribers
 
 class Repository(db.Model):
         url = db.StringProperty(required=True)
@@ -35,42 +36,19 @@ class Repository(db.Model):
         description = db.StringProperty(required=False)
         private = db.BooleanProperty(default=False)
         approved = db.BooleanProperty(default=False)
+        rejected = db.BooleanProperty(default=False)
         last_update = db.DateTimeProperty(auto_now=True)
         first_seen = db.DateTimeProperty(auto_now_add=True)
 
         @staticmethod
-        def fromJSON(json):
-                if "url" not in json:
-                        raise MissingParamException("url")
-                url = json["url"]
-                if "owner" not in json:
-                        raise MissingParamException("owner")
-                if "email" not in json["owner"]:
-                        raise MissingParamException("owner.email")
-                if "name" not in json["owner"]:
-                        raise MissingParamException("owner.name")
-                owner_email = json["owner"]["email"]
-                owner_name = json["owner"]["name"]
-                owner_hash = hashlib.md5(json["owner"]["email"].strip().lower()).hexdigest()                
-                name = url.split("/")[-1]
-                if "name" in json:
-                        name = json["name"]
-                forks = 0
-                if "forks" in json:
-                        forks = json["forks"]
-                watchers = 0
-                if "watchers" in json:
-                        watchers = json["watchers"]
-                description = None
-                if "description" in json:
-                        description = json["description"]
-                private = False
-                if "private" in json:
-                        private = json["private"] == 1
-                repo = Repository(url=url, owner_email=owner_email,
-                                owner_name=owner_name, name=name, forks=forks, 
-                                watchers=watchers, description=description,
-                                private=private, owner_hash=owner_hash)
+        def fromPayload(fields):
+                repo = Repository(url=fields["url"],
+                                owner_email=fields["owner_email"],
+                                owner_name=fields["owner_name"], name=fields["name"],
+                                forks=fields["forks"], watchers=fields["watchers"],
+                                description=fields["description"],
+                                private=fields["private"],
+                                owner_hash=fields["owner_hash"])
                 return repo
 
 class Commit(db.Model):
@@ -86,80 +64,399 @@ class Commit(db.Model):
         added = db.StringListProperty()
         repository = db.ReferenceProperty(Repository, collection_name="commits")
         num_curses = db.IntegerProperty(default=0)
+        repo_approved = db.BooleanProperty(default=False)
+        received = db.DateTimeProperty(auto_now_add=True)
+        # Set by the /metric task just before it adds the commit to the
+        # counters; None on commits stored before it existed, which were
+        # counted as they arrived.
+        counted_at = db.DateTimeProperty()
+        # The /metric batch that claimed it, so a retry of that batch can
+        # claim it again.
+        counted_by = db.StringProperty()
 
         @staticmethod
-        def fromJSON(repo, json):
-                if "id" not in json:
-                        raise MissingParamException("id")
-                id = json["id"]
-                if "url" not in json:
-                        raise MissingParamException("url")
-                url = json["url"]
-                if "author" not in json:
-                        raise MissingParamException("author")
-                if "email" not in json["author"]:
-                        raise MissingParamException("author.email")
-                if "name" not in json["author"]:
-                        raise MissingParamException("author.name")
-                author_name = json["author"]["name"]
-                author_email = json["author"]["email"]
-                author_hash = hashlib.md5(json["author"]["email"].strip().lower()).hexdigest()
-                pusher = None
-                if "pusher" in json:
-                        if "name" in json["pusher"]:
-                                pusher = json["pusher"]["name"]
-                timestamp = datetime.now()
-                if "timestamp" in json:
-                        offset = None
-                        if json["timestamp"].rindex("-") > json["timestamp"].index("T"):
-                                offset = ("-", json["timestamp"].rsplit("-", 1)[-1])
-                                json["timestamp"] = json["timestamp"].rsplit(
-                                                "-", 1)[0]
-                        if "+" in json["timestamp"]:
-                                offset = ("+", json["timestamp"].split("+")[-1])
-                                json["timestamp"] = json["timestamp"].split(
-                                                "+")[0]
-                        timestamp = datetime.strptime(json["timestamp"],
-                                "%Y-%m-%dT%H:%M:%S")
-                        hours = int(offset[1].split(":")[0])
-                        minutes = int(offset[1].split(":")[1])
-                        if offset[0] == "+":
-                                timestamp = timestamp + timedelta(hours=hours, 
-                                                minutes=minutes)
-                        else:
-                                timestamp = timestamp - timedelta(minutes=minutes,
-                                                hours=hours)
-                message = None
-                summary = None
-                if "message" in json:
-                        message = json["message"]
-                        summary = json["message"][0:139]
-                added = []
-                if "added" in json:
-                        added = json["added"]
-                commit = Commit(id=id, url=url, author_name=author_name,
-                                author_email=author_email, timestamp=timestamp,
-                                message=message, summary=summary, added=added,
-                                repository=repo, author_hash=author_hash,
-                                pusher=pusher)
+        def fromPayload(repo, fields, pusher=None):
+                timestamp = fields["timestamp"]
+                if timestamp is None:
+                        timestamp = datetime.utcnow()
+                commit = Commit(id=fields["id"], url=fields["url"],
+                                author_name=fields["author_name"],
+                                author_email=fields["author_email"],
+                                timestamp=timestamp, message=fields["message"],
+                                summary=fields["summary"], added=fields["added"],
+                                repository=repo, author_hash=fields["author_hash"],
+                                pusher=pusher, repo_approved=repo.approved,
+                                key_name=Commit.keyName(fields["id"]))
                 return commit
 
+        @staticmethod
+        def keyName(id):
+                # Forks and branches share SHAs, so the SHA alone identifies a
+                # commit no matter which repository delivered it.
+                return "sha:" + id
+
+        @staticmethod
+        def putIfAbsent(commit):
+                if Commit.get(commit.key()) is not None:
+                        return False
+                commit.put()
+                return True
+
+        # Stores the commits the datastore hasn't seen yet and returns them.
+        # Each commit is its own entity group, so checking and storing it in
+        # one transaction keeps concurrent redeliveries of a push from both
+        # taking it.
+        @staticmethod
+        def putUnseen(commits):
+                unique = []
+                key_names = []
+                for commit in commits:
+                        key_name = commit.key().name()
+                        if key_name not in key_names:
+                                unique.append(commit)
+                                key_names.append(key_name)
+                if not unique:
+                        return []
+                # One batch get weeds out most of a redelivered push.
+                stored = Commit.get_by_key_name(key_names)
+                unseen = []
+                try:
+                        for commit, existing in zip(unique, stored):
+                                if existing is None and db.run_in_transaction(
+                                                Commit.putIfAbsent, commit):
+                                        unseen.append(commit)
+                except:
+                        # Undo the partial push so GitHub's retry isn't dropped.
+                        db.delete(unseen)
+                        raise
+                return unseen
+
 class GlobalMetric(db.Model):
         nature = db.StringProperty() # commit or curse
         count = db.IntegerProperty()
        
 class RepoMetric(db.Model):
         url = db.StringProperty()
-        count = db.IntegerProperty()
+        count = db.IntegerProperty(indexed=False)
         nature = db.StringProperty() # commit or curse
 
 class AuthorMetric(db.Model):
         email = db.StringProperty()
         name = db.StringProperty()
-        count = db.IntegerProperty()
+        count = db.IntegerProperty(indexed=False)
         nature = db.StringProperty() # commit or curse
         repometric = db.ReferenceProperty(RepoMetric, collection_name="authors")
 
+# Sets one property of a stored commit in a transaction that re-reads it, so
+# a stale copy can't write back fields another task changed meanwhile.
+def _set_commit_field(key, name, value):
+        commit = Commit.get(key)
+        if commit is None or getattr(commit, name) == value:
+                return
+        setattr(commit, name, value)
+        commit.put()
+
+# Recounts a batch of stored commits for a backfill, rescoring their curses
+# with the current lexicon. Only commits counted before the backfill started
+# are recounted; the rest are left to the /metric task and the live counters,
+# and aren't written here so the task's own put can't be overwritten.
+def counted_before(commit, started):
+        if commit.counted_at is None:
+                return commit.received is None
+        return commit.counted_at < started
+
+def tally_commits(commits, started):
+        commits = [commit for commit in commits if counted_before(commit, started)]
+        repo_keys = []
+        for commit in commits:
+                repo_key = Commit.repository.get_value_for_datastore(commit)
+                if repo_key not in repo_keys:
+                        repo_keys.append(repo_key)
+        urls = {}
+        for repo in db.get(repo_keys):
+                if repo is not None:
+                        urls[repo.key()] = repo.url
+        counts = {}
+        names = {}
+        curse_counts = profanity.score([commit.message for commit in commits])
+        for commit, curses_used in zip(commits, curse_counts):
+                if commit.num_curses != curses_used:
+                        db.run_in_transaction(_set_commit_field, commit.key(),
+                                        "num_curses", curses_used)
+                names[commit.author_email] = commit.author_name
+                url = urls.get(Commit.repository.get_value_for_datastore(commit))
+                for name, amount in pipeline.counters_for(commit.author_email, url,
+                                curses_used):
+                        counts[name] = counts.get(name, 0) + amount
+        return counts, names
+
+backfill.register(Commit, tally_commits)
+
+# Marks a commit counted unless another /metric batch already has. The check
+# and the mark share a transaction, so a duplicated task can't count it too.
+def _claim_commit(key, curses_used, repo_approved, batch):
+        commit = Commit.get(key)
+        if commit.counted_at is not None:
+                if batch is not None and commit.counted_by == batch:
+                        return commit
+                return None
+        commit.counted_at = datetime.utcnow()
+        commit.counted_by = batch
+        commit.num_curses = curses_used
+        # The repo may have been approved while this push was queued, after
+        # the backfill had already passed it.
+        if repo_approved is not None:
+                commit.repo_approved = repo_approved
+        commit.put()
+        return commit
+
+METRIC_MODELS = {"global": GlobalMetric, "repo": RepoMetric, "author": AuthorMetric}
+
+class DatastoreStorage(storage.Storage):
+        # Repository records keep their entity so commits can reference it.
+        def repository_record(self, repo):
+                return {"key": repo.key(), "entity": repo, "url": repo.url,
+                        "name": repo.name, "owner_name": repo.owner_name,
+                        "owner_email": repo.owner_email, "owner_hash": repo.owner_hash,
+                        "description": repo.description, "forks": repo.forks,
+                        "watchers": repo.watchers, "private": repo.private,
+                        "approved": repo.approved}
+
+        def commit_record(self, commit):
+                return {"id": commit.id, "url": commit.url,
+                        "author_name": commit.author_name,
+                        "author_email": commit.author_email,
+                        "author_hash": commit.author_hash, "pusher": commit.pusher,
+                        "timestamp": commit.timestamp, "message": commit.message,
+                        "summary": commit.summary, "added": commit.added,
+                        "num_curses": commit.num_curses,
+                        "repo_approved": commit.repo_approved}
+
+        def find_repository(self, url):
+                repo = Repository.all().filter("url =", url).get()
+                if repo is None:
+                        return None
+                return self.repository_record(repo)
+
+        def add_repository(self, fields):
+                repo = Repository.fromPayload(fields)
+                repo.put()
+                return self.repository_record(repo)
+
+        def add_commits(self, repo, commits, pusher=None):
+                repository = repo["entity"]
+                stored = Commit.putUnseen([Commit.fromPayload(repository, fields, pusher)
+                                for fields in commits])
+                if not stored:
+                        return []
+                repository.last_update = datetime.now()
+                try:
+                        repository.put()
+                except:
+                        db.delete(stored)
+                        raise
+                return [self.commit_record(cmt) for cmt in stored]
+
+        def discard_commits(self, commits):
+                db.delete([db.Key.from_path("Commit", Commit.keyName(commit["id"]))
+                                for commit in commits])
+
+        def claim_commits(self, ids, score, batch=None):
+                if batch is not None and counters.batch_done(batch):
+                        return []
+                stored = Commit.get_by_key_name([Commit.keyName(id) for id in ids])
+                pending = [commit for commit in stored if commit is not None and (
+                        commit.counted_at is None
+                        or (batch is not None and commit.counted_by == batch))]
+                if not pending:
+                        return []
+                repo_keys = []
+                for commit in pending:
+                        repo_key = Commit.repository.get_value_for_datastore(commit)
+                        if repo_key not in repo_keys:
+                                repo_keys.append(repo_key)
+                approved = {}
+                for repo in db.get(repo_keys):
+                        if repo is not None:
+                                approved[repo.key()] = repo.approved
+                unscored = [commit for commit in pending if commit.counted_at is None]
+                curse_counts = dict(zip([commit.key() for commit in unscored],
+                                score([commit.message for commit in unscored])))
+                claimed = []
+                for commit in pending:
+                        # A commit this batch already claimed keeps its score.
+                        commit = db.run_in_transaction(_claim_commit, commit.key(),
+                                        curse_counts.get(commit.key(), commit.num_curses),
+                                        approved.get(Commit.repository.get_value_for_datastore(commit)),
+                                        batch)
+                        if commit is not None:
+                                claimed.append(commit)
+                return [self.commit_record(commit) for commit in claimed]
+
+        def recent_commits(self, limit):
+                commits = Commit.all().filter("repo_approved =", True).order(
+                                "-timestamp").fetch(limit)
+                repo_keys = []
+                for commit in commits:
+                        repo_key = Commit.repository.get_value_for_datastore(commit)
+                        if repo_key not in repo_keys:
+                                repo_keys.append(repo_key)
+                repos = {}
+                for repo in db.get(repo_keys):
+                        # Commits of a repo that was just rejected are still flagged
+                        # approved until its /approval chain reaches them.
+                        if repo is not None and repo.approved:
+                                repos[repo.key()] = repo
+                recent = []
+                for commit in commits:
+                        repo = repos.get(Commit.repository.get_value_for_datastore(commit))
+                        if repo is not None:
+                                recent.append(commit_summary(commit, repo))
+                return recent
+
+        def increment(self, deltas):
+                totals = {}
+                for name, delta in deltas.items():
+                        total = counters.increment(name, delta)
+                        if total is not None:
+                                totals[name] = total
+                unchanged = [name for name in deltas if name not in totals]
+                if unchanged:
+                        totals.update(counters.get_counts(unchanged))
+                return totals
+
+        def increment_once(self, batch, deltas):
+                return counters.increment_batch(batch, deltas)
+
+        def finish_batch(self, batch):
+                counters.finish_batch(batch)
+
+        def get_counts(self, names):
+                return counters.get_counts(names)
+
+        # Rows are rebuilt from the counter names, so only authors without a
+        # name in author_names are read, to keep their stored name.
+        def put_metrics(self, totals, author_names):
+                updated = []
+                unnamed = []
+                for name, count in totals.items():
+                        scope, nature, subject = storage.split_counter(name)
+                        if scope not in METRIC_MODELS:
+                                continue
+                        key_name = nature
+                        if subject:
+                                key_name = nature + ":" + subject
+                        metric = METRIC_MODELS[scope](key_name=key_name, nature=nature,
+                                        count=count)
+                        if scope == "repo":
+                                metric.url = subject
+                        elif scope == "author":
+                                metric.email = subject
+                                metric.name = author_names.get(subject)
+                                if metric.name is None:
+                                        unnamed.append(metric)
+                        updated.append(metric)
+                for start in range(0, len(unnamed), 500):
+                        batch = unnamed[start:start + 500]
+                        stored = AuthorMetric.get_by_key_name([metric.key().name()
+                                        for metric in batch])
+                        for metric, existing in zip(batch, stored):
+                                if existing is not None:
+                                        metric.name = existing.name
+                for start in range(0, len(updated), 500):
+                        db.put(updated[start:start + 500])
+
+        def metrics(self, scope, nature):
+                entries = []
+                for metric in METRIC_MODELS[scope].all().filter("nature =", nature):
+                        if metric.key().name() is None:
+                                # Not yet folded into the counters by /migrate.
+                                continue
+                        subject = None
+                        if scope == "repo":
+                                subject = metric.url
+                        elif scope == "author":
+                                subject = metric.email
+                        entries.append((metric.key().name(), storage.metric_fields(
+                                scope, subject, getattr(metric, "name", None)), metric.count))
+                return entries
+
+STORAGE = DatastoreStorage()
+
+DASHBOARD_COMMITS = 10
+DASHBOARD_KEY = "dashboard"
+
+class DashboardSnapshot(db.Model):
+        data = db.TextProperty()
+        last_update = db.DateTimeProperty(auto_now=True)
+
+def commit_summary(commit, repo):
+        return storage.summarize(STORAGE.commit_record(commit),
+                        {"name": repo.name, "url": repo.url})
+
+def _metric_source(scope, nature):
+        def source():
+                return STORAGE.metrics(scope, nature)
+        return source
+
+for scope in ("author", "repo"):
+        for nature in ("commit", "curse"):
+                leaderboard.register(counters.counter_name(scope, nature),
+                                _metric_source(scope, nature))
+
+def leaderboards():
+        boards = leaderboard.get_boards(["author:commit", "author:curse",
+                "repo:commit", "repo:curse"])
+        return {"authors_desc": boards["author:commit"]["desc"],
+                "authors_asc": boards["author:commit"]["asc"],
+                "repos_desc": boards["repo:commit"]["desc"],
+                "repos_asc": boards["repo:commit"]["asc"],
+                "curse_authors_desc": boards["author:curse"]["desc"],
+                "curse_authors_asc": boards["author:curse"]["asc"],
+                "curse_repos_desc": boards["repo:curse"]["desc"],
+                "curse_repos_asc": boards["repo:curse"]["asc"]}
+
+def save_dashboard(dashboard):
+        DashboardSnapshot(key_name=DASHBOARD_KEY,
+                        data=simplejson.dumps(dashboard)).put()
+        # Set rather than deleted, so a reader that fetched the old snapshot
+        # can't add it back.
+        memcache.set(DASHBOARD_KEY, dashboard, time=60)
+
+def build_dashboard():
+        approved_commits = STORAGE.recent_commits(DASHBOARD_COMMITS)
+        global_commit_counter = counters.counter_name("global", "commit")
+        global_curse_counter = counters.counter_name("global", "curse")
+        totals = STORAGE.get_counts([global_commit_counter,
+                global_curse_counter])
+        dashboard = leaderboards()
+        dashboard["commits"] = approved_commits
+        dashboard["global_commits"] = totals[global_commit_counter]
+        dashboard["global_curses"] = totals[global_curse_counter]
+        save_dashboard(dashboard)
+        return dashboard
+
+def get_dashboard():
+        dashboard = memcache.get(DASHBOARD_KEY)
+        if dashboard is None:
+                snapshot = DashboardSnapshot.get_by_key_name(DASHBOARD_KEY)
+                if snapshot is None:
+                        dashboard = build_dashboard()
+                else:
+                        dashboard = simplejson.loads(snapshot.data)
+                memcache.add(DASHBOARD_KEY, dashboard, time=60)
+        return dashboard
+
+# App Engine strips X-AppEngine-QueueName from outside requests, so only the
+# task queue can reach a handler wrapped in this.
+def task_only(method):
+        def guarded(self, *args):
+                if "X-AppEngine-QueueName" not in self.request.headers:
+                        self.error(403)
+                        return
+                return method(self, *args)
+        return guarded
+
 class MainPage(webapp.RequestHandler):
         def get(self):
                 now = time.time()
@@ -167,55 +464,10 @@ class MainPage(webapp.RequestHandler):
                 req_id = req_id[0:63] # Generate a pseudo-unique string to use
                                       # as the channel ID
                 new_token = channel.create_channel(req_id)
-                expires = now + (60 * 60 * 2)
-                tokens = memcache.get("tokens")
-                valid_tokens = []
-                if tokens is None:
-                        tokens = []
-                for id, token, expiration in tokens:
-                        logging.info(id)
-                        logging.info(token)
-                        logging.info(expiration)
-                        if expiration > time.time():
-                                valid_tokens.append((id, token, expiration))
-                valid_tokens.append((req_id, new_token, expires))
-                memcache.set("tokens", valid_tokens)
-                
-                commits = Commit.all().order("-timestamp").fetch(1000)
-                approved_commits = []
-                for commit in commits:
-                        if commit.repository.approved:
-                                approved_commits.append(commit)
-                        if len(approved_commits) > 9:
-                                break
-                global_commits = 0
-                global_curses = 0
-                commit_query = GlobalMetric.all().filter("nature = ", "commit").get()
-                if commit_query:
-                        global_commits = commit_query.count
-
-                curse_query = GlobalMetric.all().filter("nature = ", "curse").get()
-                if curse_query:
-                        global_curses = curse_query.count
-
-                authors_desc = []
-                authors_asc = []
-                repos_desc = []
-                repos_asc = []
-                authors_d = AuthorMetric.all().filter("nature =", "commit").order("-count").fetch(1000)
-                authors_a = AuthorMetric.all().filter("nature =", "commit").order("count").fetch(10)
-                repos_d = RepoMetric.all().filter("nature =", "commit").order("-count").fetch(1000)
-                repos_a = RepoMetric.all().filter("nature =", "commit").order("count").fetch(10)
-                for author in authors_d:
-                        authors_desc.append({"count": author.count, "name": author.name, "email": author.email})
-                for author in authors_a:
-                        authors_asc.append({"count": author.count, "name": author.name, "email": author.email})
-                for repo in repos_d:
-                        repos_desc.append({"count": repo.count, "url": repo.url, "name": repo.url.split("/")[-1]})
-                for repo in repos_a:
-                        repos_asc.append({"count": repo.count, "url": repo.url, "name": repo.url.split("/")[-1]})
-                
-                template_values = {"token": new_token, "page": "main", "authors_desc": authors_desc, "authors_asc": authors_asc, "repos_asc": repos_asc, "repos_desc": repos_desc, "commits": approved_commits, "global_commit_count": global_commits, "global_curse_count": global_curses}
+                subscribers.subscribe(req_id)
+
+                dashboard = get_dashboard()
+                template_values = {"token": new_token, "page": "main", "authors_desc": dashboard["authors_desc"], "authors_asc": dashboard["authors_asc"], "repos_asc": dashboard["repos_asc"], "repos_desc": dashboard["repos_desc"], "curse_authors_desc": dashboard["curse_authors_desc"], "curse_repos_desc": dashboard["curse_repos_desc"], "commits": dashboard["commits"], "global_commit_count": dashboard["global_commits"], "global_curse_count": dashboard["global_curses"]}
 
                 self.response.out.write(template.render('index.html', template_values))
 
@@ -228,224 +480,456 @@ class AdminPage(webapp.RequestHandler):
                 if not users.is_current_user_admin():
                         self.redirect("/")
                         return
-                repos = Repository.all().filter("approved = ", False).fetch(1000)
-                self.response.out.write(template.render("index.html", {"page": "admin", "repos": repos}))
+                keys, cursor = moderation_queue(self.request.get("cursor"))
+                repos = [repo for repo in db.get(keys) if repo is not None]
+                self.response.out.write(template.render("index.html", {"page": "admin", "repos": repos, "cursor": cursor}))
+
+MODERATION_PAGE = 25
+APPROVAL_BATCH = 100
+
+def moderation_queue(cursor=None):
+        query = Repository.all(keys_only=True).filter("approved =", False).filter(
+                        "rejected =", False).order("first_seen")
+        if cursor:
+                query.with_cursor(cursor)
+        keys = query.fetch(MODERATION_PAGE)
+        if len(keys) < MODERATION_PAGE:
+                return keys, None
+        return keys, query.cursor()
+
+# Approves or rejects repos in one batched get and put. Each repo whose
+# approval changed gets an /approval chain to reflag its commits, and the
+# dashboard is rebuilt straight away if an approved repo was rejected.
+def moderate(repo_keys, approved):
+        repos = [repo for repo in db.get(repo_keys) if repo is not None]
+        tasks = []
+        withdrawn = False
+        for repo in repos:
+                if repo.approved != approved:
+                        tasks.append(taskqueue.Task(url="/approval", params={
+                                "repo": str(repo.key()), "approved": int(approved)}))
+                        withdrawn = withdrawn or repo.approved
+                repo.approved = approved
+                repo.rejected = not approved
+        db.put(repos)
+        for start in range(0, len(tasks), taskqueue.MAX_TASKS_PER_ADD):
+                taskqueue.Queue().add(tasks[start:start + taskqueue.MAX_TASKS_PER_ADD])
+        if withdrawn:
+                build_dashboard()
+        return repos
 
 class ApproveRepo(webapp.RequestHandler):
         def post(self, repo_key):
+                if not users.is_current_user_admin():
+                        self.error(403)
+                        return
                 logging.info(repo_key)
-                repo = Repository.get(db.Key(repo_key))
-                repo.approved = True
-                repo.put()
+                moderate([db.Key(repo_key)], True)
+
+class ModerateRepos(webapp.RequestHandler):
+        def post(self):
+                if not users.is_current_user_admin():
+                        self.error(403)
+                        return
+                action = self.request.get("action")
+                if action not in ("approve", "reject"):
+                        self.error(400)
+                        self.response.out.write("action must be approve or reject")
+                        return
+                try:
+                        keys = [db.Key(key) for key in self.request.get_all("repo")]
+                except db.BadKeyError:
+                        self.error(400)
+                        self.response.out.write(str(sys.exc_info()[1]))
+                        return
+                repos = moderate(keys, action == "approve")
+                self.response.headers["Content-Type"] = "application/json"
+                self.response.out.write(simplejson.dumps(
+                                [str(repo.key()) for repo in repos]))
+
+class ApprovalWorker(webapp.RequestHandler):
+        @task_only
+        def post(self):
+                repo_key = db.Key(self.request.get("repo"))
+                approved = self.request.get("approved", "1") != "0"
+                query = Commit.all().filter("repository =", repo_key)
+                cursor = self.request.get("cursor")
+                if cursor:
+                        query.with_cursor(cursor)
+                commits = query.fetch(APPROVAL_BATCH)
+                for commit in commits:
+                        if commit.repo_approved != approved:
+                                db.run_in_transaction(_set_commit_field, commit.key(),
+                                                "repo_approved", approved)
+                if len(commits) == APPROVAL_BATCH:
+                        taskqueue.add(url="/approval", params={
+                                "repo": str(repo_key), "approved": int(approved),
+                                "cursor": query.cursor()})
+                else:
+                        build_dashboard()
 
 
 class HookReceiver(webapp.RequestHandler):
         def post(self):
-                logging.info(self.request.body)
-                logging.info(self.request.get("payload"))
-                body = simplejson.loads(self.request.get("payload"))
-                repository = Repository.all().filter("url =", body["repository"]["url"]).get()
-                if not repository:
-                        repository = Repository.fromJSON(body["repository"])
-                        repository.put()
-                for commit in body["commits"]:
-                        commit['pusher'] = body['pusher']
-                        cmt = Commit.fromJSON(repository, commit)
-                        cmt.put()
-                        repository.last_update = datetime.now()
-                        repository.put()
-                        taskqueue.add(url="/metric", params={"id": cmt.id, "author_email": cmt.author_email, "author_name": cmt.author_name, "repo": cmt.repository.url, 
-                                "message": cmt.message})
-                        c = {
-                                        "id": cmt.id,
-                                        "url": cmt.url,
-                                        "author_name": cmt.author_name,
-                                        "author_hash": cmt.author_hash,
-                                        "timestamp": cmt.timestamp,
-                                        "message": cmt.summary,
-                                        "repo_name": cmt.repository.name,
-                                        "repo_url": cmt.repository.url,
-                                        "pusher": cmt.pusher,
-                                        "origin": "commit"
-                                }
-                        taskqueue.add(url="/pusher", params=c) 
+                text = self.request.get("payload")
+                stats.observe("payload_bytes", len(text))
+                try:
+                        push = payload.decode_push(text)
+                except payload.PayloadException:
+                        self.error(400)
+                        self.response.out.write(str(sys.exc_info()[1]))
+                        return
+                stats.observe("commits_per_push", len(push["commits"]))
+                stats.sample_log("github_payload",
+                                {"repo": push["repository"]["url"],
+                                 "commits": len(push["commits"])}, text)
+                repository = STORAGE.find_repository(push["repository"]["url"])
+                if repository is None:
+                        repository = STORAGE.add_repository(push["repository"])
+                commits = STORAGE.add_commits(repository, push["commits"],
+                                push["pusher"])
+                if not commits:
+                        return
+
+                updates = []
+                for cmt in commits:
+                        updates.append({
+                                        "id": cmt["id"],
+                                        "url": cmt["url"],
+                                        "author_name": cmt["author_name"],
+                                        "author_hash": cmt["author_hash"],
+                                        "timestamp": str(cmt["timestamp"]),
+                                        "message": cmt["summary"],
+                                        "repo_name": repository["name"],
+                                        "repo_url": repository["url"],
+                                        "pusher": cmt["pusher"]
+                                })
+                # One task per push for each worker, enqueued in a single RPC.
+                # If that fails the push is undone, so GitHub's redelivery
+                # isn't dropped as already seen.
+                try:
+                        taskqueue.Queue().add([
+                                taskqueue.Task(url="/metric", params={
+                                        "repo": repository["url"],
+                                        "commits": simplejson.dumps([cmt["id"] for cmt in commits])}),
+                                taskqueue.Task(url="/pusher", params={
+                                        "origin": "commits",
+                                        "commits": simplejson.dumps(updates)})
+                                ])
+                except:
+                        STORAGE.discard_commits(commits)
+                        raise
 
 class PushWorker(webapp.RequestHandler):
+        @task_only
         def post(self):
                 origin = self.request.get("origin")
-                u = None
-                if origin == "commit":
-                        id = self.request.get("id")
-                        url = self.request.get("url")
-                        author_name = self.request.get("author_name")
-                        author_hash = self.request.get("author_hash")
-                        timestamp = self.request.get("timestamp")
-                        message = self.request.get("message")
-                        repo_name = self.request.get("repo_name")
-                        repo_url = self.request.get("repo_url")
-                        pusher = self.request.get("pusher")
-                
-                        u = {
-                                "nature": "commit",
-                                "id": id,
-                                "url": url,
-                                "author_name": author_name,
-                                "author_hash": author_hash,
-                                "timestamp": timestamp,
-                                "message": message,
-                                "repo_name": repo_name,
-                                "pusher": pusher,
-                                "repo_url": repo_url
-                        }
+                message = None
+                if origin == "commits":
+                        commits = simplejson.loads(self.request.get("commits"))
+                        if commits:
+                                message = protocol.commits_message(commits)
                 elif origin == "metrics":
-                        authors_desc = []
-                        authors_asc = []
-                        repos_desc = []
-                        repos_asc = []
-                        authors_d = AuthorMetric.all().filter("nature =", "commit").order("-count").fetch(10)
-                        authors_a = AuthorMetric.all().filter("nature =", "commit").order("count").fetch(10)
-                        repos_d = RepoMetric.all().filter("nature =", "commit").order("-count").fetch(10)
-                        repos_a = RepoMetric.all().filter("nature =", "commit").order("count").fetch(10)
-                        for author in authors_d:
-                                authors_desc.append({"count": author.count, "name": author.name})
-                        for author in authors_a:
-                                authors_asc.append({"count": author.count, "name": author.name})
-                        for repo in repos_d:
-                                repos_desc.append({"count": repo.count, "url": repo.url})
-                        for repo in repos_a:
-                                repos_asc.append({"count": repo.count, "url": repo.url})
-                        u = {
-                                "nature": "metrics",
-                                "global_commits": self.request.get("global_commits"),
-                                "global_curses": self.request.get("global_curses"),
-                                "author": {
-                                        "desc": authors_desc,
-                                        "asc": authors_asc
-                                },
-                                "repo": {
-                                        "desc": repos_desc,
-                                        "asc": repos_asc
-                                }
-                        }
-                if u is not None:
-                        tokens = memcache.get("tokens")
-                        valid_tokens = []
-                        if tokens is None:
-                                tokens = []
-                        for id, token, expiration in tokens:
-                                if expiration > time.time():
-                                        valid_tokens.append((id, token, expiration))
-                                        channel.send_message(id, simplejson.dumps(u))
-                        memcache.set("tokens", valid_tokens)
+                        # The snapshot is rebuilt here, once per window, rather
+                        # than by every /metric task.
+                        message = protocol.metrics_message(build_dashboard(),
+                                        rollups.latest("global")["commit"]["minute"])
+                if message is not None:
+                        subscribers.broadcast([message])
+
+class StatePage(webapp.RequestHandler):
+        def get(self):
+                message = protocol.resync_message(get_dashboard(),
+                                rollups.latest("global")["commit"]["minute"])
+                self.response.headers["Content-Type"] = "application/json"
+                self.response.out.write(simplejson.dumps(message,
+                                separators=(",", ":")))
 
-class AwardsWorker(webapp.RequestHandler):
-        def post(self):
-                global_commits = self.request.get("global_commits")
-                author_name = self.request.get("author_name")
-                author_email = self.request.get("author_email")
-
-                if global_commits == 100:
-                        mail.send_mail_to_admins("admin_email@example.com", "UB Hacking 100th Commit", "%s (%s) deserves a prize for the 100th commit tonight." % (author_name, author_email))
-                elif global_commits == 150:
-                        mail.send_mail_to_admins("admin_email@example.com", "UB Hacking 150th Commit", "%s (%s) deserves a prize for the 150th commit tonight." % (author_name, author_email))
-                elif global_commits == 200:
-                        mail.send_mail_to_admins("admin_email@example.com", "UB Hacking 200th Commit", "%s (%s) deserves a prize for the 200th commit tonight." % (author_name, author_email))
-                elif global_commits == 250:
-                        mail.send_mail_to_admins("admin_email@example.com", "UB Hacking 250th Commit", "%s (%s) deserves a prize for the 250th commit tonight." % (author_name, author_email))
-                elif global_commits == 500:
-                        mail.send_mail_to_admins("admin_email@example.com", "UB Hacking 500th Commit", "%s (%s) deserves a prize for the 500th commit tonight." % (author_name, author_email))
-                elif global_commits == 750:
-                        mail.send_mail_to_admins("admin_email@example.com", "UB Hacking 750th Commit", "%s (%s) deserves a prize for the 750th commit tonight." % (author_name, author_email))
-                elif global_commits == 1000:
-                        mail.send_mail_to_admins("admin_email@example.com", "UB Hacking 1000th Commit", "%s (%s) deserves a prize for the 1000th commit tonight." % (author_name, author_email))
+class StatsPage(webapp.RequestHandler):
+        def get(self):
+                if not users.is_current_user_admin():
+                        self.error(403)
+                        return
+                self.response.headers["Content-Type"] = "application/json"
+                self.response.out.write(simplejson.dumps(stats.snapshot(ROUTES)))
 
-class MetricWorker(webapp.RequestHandler):
+class RollupsPage(webapp.RequestHandler):
+        def get(self):
+                scope = self.request.get("scope", "global")
+                nature = self.request.get("nature", "commit")
+                resolution = self.request.get("resolution", "minute")
+                if resolution not in rollups.RESOLUTIONS or nature not in ("commit", "curse"):
+                        self.error(400)
+                        return
+                try:
+                        end = int(self.request.get("end", time.time()))
+                        start = int(self.request.get("start", end - 60 * 60))
+                except ValueError:
+                        self.error(400)
+                        return
+                if start > end:
+                        self.error(400)
+                        return
+                points = rollups.series(scope, nature, resolution, start, end)
+                self.response.headers["Content-Type"] = "application/json"
+                self.response.out.write(simplejson.dumps({"scope": scope,
+                        "nature": nature, "resolution": resolution,
+                        "points": points}))
+
+class RollupFlushWorker(webapp.RequestHandler):
+        @task_only
         def post(self):
-                total_curses_used = 0 
-
-                commit_id = self.request.get("id")
-                author_email = self.request.get("author_email")
-                author_name = self.request.get("author_name")
-                repo = self.request.get("repo")
-                message = self.request.get("message")
-                r = re.compile("[^\w]ass[^\w]|[^\w]asshole[^\w]|[^\w]dumbass[^\w]|[^\w]hell[^\w]|fuck|shit|damn|bitch|bastard", flags=re.IGNORECASE)
-                found_words = r.findall(message)
-                total_curses_used = len(found_words)
-
-                updated_entries = []
+                rollups.flush(int(self.request.get("window")))
 
-                if total_curses_used > 0:
-                        cmt = Commit.all().filter("id =", commit_id).get()
-                        cmt.num_curses = total_curses_used
-                        updated_entries.append(cmt)
-
-                query = GlobalMetric.all().filter("nature = ", "commit").get()
-                if not query:
-                        query = GlobalMetric(nature="commit", count=1)
-                else:
-                        query.count += 1
-                updated_entries.append(query)
-                global_commits = query.count
-
-                query = GlobalMetric.all().filter("nature = ", "curse").get()
-                if not query:
-                        query = GlobalMetric(nature="curse", count=total_curses_used)
-                else:
-                        query.count += total_curses_used
-                updated_entries.append(query)
-                global_curses = query.count
+class FanoutWorker(webapp.RequestHandler):
+        @task_only
+        def post(self):
+                bucket = int(self.request.get("bucket"))
+                messages = simplejson.loads(self.request.get("messages"))
+                subscribers.send_to_bucket(bucket, messages)
 
-                repo_commit_query = RepoMetric.all().filter("nature = ", "commit").filter("url = ", repo).get()
-                if not repo_commit_query:
-                        repo_commit_query = RepoMetric(url=repo, count=1, nature="commit")
+class AwardsWorker(webapp.RequestHandler):
+        @task_only
+        def post(self):
+                awards.send(self.request.get("milestone"))
+
+# Metric updates are folded into one leaderboard broadcast per window (in
+# seconds); commit events are still pushed as soon as they arrive.
+METRICS_WINDOW = 1
+
+def schedule_metrics_broadcast():
+        window = int(time.time() / METRICS_WINDOW)
+        countdown = (window + 1) * METRICS_WINDOW - time.time()
+        # The task name is unique per window, so only the first update in a
+        # window enqueues it; it runs after the window closes and rebuilds
+        # the dashboard from every update in the window.
+        try:
+                taskqueue.add(url="/pusher", params={"origin": "metrics"},
+                                name="metrics-%d" % window,
+                                countdown=max(countdown, 0))
+        except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+                pass
+
+class BackfillPage(webapp.RequestHandler):
+        def get(self):
+                if not users.is_current_user_admin():
+                        self.error(403)
+                        return
+                job = self.request.get("job")
+                if job:
+                        report = backfill.progress(job)
                 else:
-                        repo_commit_query.count += 1
-                repo_commit_query.put()
+                        report = backfill.latest()
+                self.response.headers["Content-Type"] = "application/json"
+                self.response.out.write(simplejson.dumps(report))
 
-                repo_curse_query = RepoMetric.all().filter("nature = ", "curse").filter("url = ", repo).get()
-                if not repo_curse_query:
-                        repo_curse_query = RepoMetric(url=repo, count=total_curses_used, nature="curse")
-                else:
-                        repo_curse_query.count += total_curses_used
-                repo_curse_query.put()
+        def post(self):
+                if not users.is_current_user_admin():
+                        self.error(403)
+                        return
+                try:
+                        shards = int(self.request.get("shards", backfill.SHARDS))
+                except ValueError:
+                        self.error(400)
+                        return
+                job = backfill.start(max(1, shards))
+                self.response.headers["Content-Type"] = "application/json"
+                self.response.out.write(simplejson.dumps(backfill.progress(job)))
 
-                query = AuthorMetric.all().filter("nature = ", "commit").filter("email = ", author_email).get()
-                if not query:
-                        query = AuthorMetric(email=author_email, name=author_name, count=1, nature="commit", repometric=repo_commit_query)
-                else:
-                        query.count += 1
-                updated_entries.append(query)
+class BackfillShardWorker(webapp.RequestHandler):
+        @task_only
+        def post(self):
+                backfill.run_shard(self.request.get("job"),
+                                int(self.request.get("shard")),
+                                int(self.request.get("step")))
 
-                query = AuthorMetric.all().filter("nature = ", "curse").filter("email = ", author_email).get()
-                if not query:
-                        query = AuthorMetric(email=author_email, name=author_name, count=total_curses_used, nature="curse", repometric=repo_curse_query)
+class BackfillMergeWorker(webapp.RequestHandler):
+        @task_only
+        def post(self):
+                merged = backfill.merge(self.request.get("job"))
+                if merged is None:
+                        return
+                names, author_names = merged
+                STORAGE.put_metrics(STORAGE.get_counts(names), author_names)
+                # Recounted totals can go down, which the incremental boards
+                # never do, so rebuild them from the rewritten metric rows.
+                leaderboard.reset(leaderboard.SOURCES.keys())
+                build_dashboard()
+                schedule_metrics_broadcast()
+                logging.info("backfill %s", simplejson.dumps(
+                                backfill.progress(self.request.get("job"))))
+
+MIGRATION_BATCH = 100
+MIGRATION_SCOPES = ["global", "repo", "author"]
+
+def legacy_counter(scope, metric):
+        if scope == "repo":
+                return counters.counter_name(scope, metric.nature, metric.url)
+        if scope == "author":
+                return counters.counter_name(scope, metric.nature, metric.email)
+        return counters.counter_name(scope, metric.nature)
+
+def _migrate_metric(key, name):
+        metric = db.get(key)
+        if metric is None:
+                return False
+        counters.seed(name, metric.count or 0)
+        metric.delete()
+        return True
+
+class MigratePage(webapp.RequestHandler):
+        def post(self):
+                if not users.is_current_user_admin():
+                        self.error(403)
+                        return
+                taskqueue.Queue().add([
+                        taskqueue.Task(url="/migrate/metrics", params={"scope": "global"}),
+                        taskqueue.Task(url="/migrate/repos")])
+
+# Folds metric rows written before the counters were sharded, which have
+# datastore ids rather than key names, into the counters and deletes them.
+class MigrateMetricsWorker(webapp.RequestHandler):
+        @task_only
+        def post(self):
+                scope = self.request.get("scope")
+                query = METRIC_MODELS[scope].all().order("__key__")
+                cursor = self.request.get("cursor")
+                if cursor:
+                        query.with_cursor(cursor)
+                metrics = query.fetch(MIGRATION_BATCH)
+                # Ids sort before key names, so the legacy rows come first.
+                legacy = [metric for metric in metrics if metric.key().name() is None]
+                deltas = {}
+                author_names = {}
+                options = db.create_transaction_options(xg=True)
+                for metric in legacy:
+                        name = legacy_counter(scope, metric)
+                        if db.run_in_transaction_options(options, _migrate_metric,
+                                        metric.key(), name):
+                                deltas[name] = deltas.get(name, 0) + (metric.count or 0)
+                        if scope == "author":
+                                author_names[metric.email] = metric.name
+                if deltas:
+                        counters.offset_cached(deltas)
+                        STORAGE.put_metrics(STORAGE.get_counts(deltas.keys()),
+                                        author_names)
+                if legacy and len(legacy) == MIGRATION_BATCH:
+                        taskqueue.add(url="/migrate/metrics", params={
+                                "scope": scope, "cursor": query.cursor()})
+                elif scope != MIGRATION_SCOPES[-1]:
+                        taskqueue.add(url="/migrate/metrics", params={
+                                "scope": MIGRATION_SCOPES[MIGRATION_SCOPES.index(scope) + 1]})
                 else:
-                        query.count += total_curses_used
-                updated_entries.append(query)
-
-
-                mets = {
-                        "origin": "metrics",
-                        "global_commits": global_commits,
-                        "global_curses": global_curses,
-                        "author_name": author_name,
-                        "author_email": author_email
-                }
-
-                db.put(updated_entries)
-                taskqueue.add(url="/pusher", params=mets)
-                taskqueue.add(url="/awards", params=mets)
+                        leaderboard.reset(leaderboard.SOURCES.keys())
+                        build_dashboard()
 
+def _migrate_repo(key):
+        repo = db.get(key)
+        if repo is not None:
+                repo.put()
+        return repo
+
+# Rewrites repos stored before they had a "rejected" property: the datastore
+# leaves a missing property out of the index, so the moderation queue's
+# "rejected = False" filter wouldn't find them. Commits stored back then have
+# no repo_approved either, so every approved repo also gets an /approval
+# chain to flag its history for the feed.
+class MigrateReposWorker(webapp.RequestHandler):
+        @task_only
+        def post(self):
+                query = Repository.all(keys_only=True).order("__key__")
+                cursor = self.request.get("cursor")
+                if cursor:
+                        query.with_cursor(cursor)
+                keys = query.fetch(MIGRATION_BATCH)
+                # One transaction per repo, so a moderation made meanwhile
+                # isn't overwritten.
+                tasks = []
+                for key in keys:
+                        repo = db.run_in_transaction(_migrate_repo, key)
+                        if repo is not None and repo.approved:
+                                tasks.append(taskqueue.Task(url="/approval", params={
+                                        "repo": str(key), "approved": 1}))
+                for start in range(0, len(tasks), taskqueue.MAX_TASKS_PER_ADD):
+                        taskqueue.Queue().add(tasks[start:start + taskqueue.MAX_TASKS_PER_ADD])
+                if len(keys) == MIGRATION_BATCH:
+                        taskqueue.add(url="/migrate/repos", params={
+                                "cursor": query.cursor()})
 
-application = webapp.WSGIApplication([
+class MetricWorker(webapp.RequestHandler):
+        @task_only
+        def post(self):
+                repo = self.request.get("repo")
+                # The task only names the commits; messages can be too long to
+                # carry, so they are read from the stored entities.
+                ids = simplejson.loads(self.request.get("commits"))
+                # Claiming the commits and adding their counts are separate
+                # writes, so they share a batch named after the push: until the
+                # batch is finished a retry reclaims the same commits, and
+                # each counter is added to once however often it runs.
+                batch = "metric-" + hashlib.sha1(",".join(ids).encode("utf-8")).hexdigest()
+                commits = STORAGE.claim_commits(ids, profanity.score, batch)
+                if not commits:
+                        return
+                shares, author_names = pipeline.contributions(repo, commits,
+                                [commit["num_curses"] for commit in commits])
+                deltas = pipeline.deltas(shares)
+                totals, applied = STORAGE.increment_once(batch, deltas)
+                # Milestones are claimed once each, so a retry can recheck them.
+                for name, share in shares:
+                        if deltas[name]:
+                                awards.check(name, totals[name] - deltas[name],
+                                                totals[name], share)
+                # The metric rows mirror the sharded totals so the leaderboards
+                # can be rebuilt; they are overwritten, never incremented.
+                STORAGE.put_metrics(totals, author_names)
+
+                rollup_deltas = []
+                boards = {}
+                for name, share in shares:
+                        scope, nature, subject = storage.split_counter(name)
+                        rollup_scope = scope
+                        if subject:
+                                rollup_scope = scope + ":" + subject
+                        if name in applied:
+                                rollup_deltas.append((rollup_scope, nature, deltas[name]))
+                        if scope in ("author", "repo"):
+                                boards.setdefault(scope + ":" + nature, []).append((
+                                        nature + ":" + subject,
+                                        storage.metric_fields(scope, subject,
+                                                author_names.get(subject)),
+                                        totals[name]))
+                rollups.record(rollup_deltas)
+                leaderboard.update(boards)
+
+                schedule_metrics_broadcast()
+                STORAGE.finish_batch(batch)
+
+
+ROUTES = [
         ('/awards', AwardsWorker),
+        ('/backfill/shard', BackfillShardWorker),
+        ('/backfill/merge', BackfillMergeWorker),
+        ('/backfill', BackfillPage),
         ('/metric', MetricWorker),
+        ('/migrate/metrics', MigrateMetricsWorker),
+        ('/migrate/repos', MigrateReposWorker),
+        ('/migrate', MigratePage),
         ('/pusher', PushWorker),
+        ('/fanout', FanoutWorker),
+        ('/rollups/flush', RollupFlushWorker),
+        ('/rollups', RollupsPage),
         ('/github', HookReceiver),
         ('/admin', AdminPage),
         ('/approve/([^/]+)', ApproveRepo),
+        ('/moderate', ModerateRepos),
+        ('/approval', ApprovalWorker),
+        ('/stats', StatsPage),
+        ('/state', StatePage),
         ('/', MainPage)
-        ])
+]
+
+application = stats.instrument(webapp.WSGIApplication(ROUTES), ROUTES)
 
 def main():
         run_wsgi_app(application)
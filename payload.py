@@ -0,0 +1,171 @@
+try:
+        from django.utils import simplejson
+except ImportError:
+        import json as simplejson
+from datetime import datetime, timedelta
+import hashlib
+import re
+
+class PayloadException(Exception):
+        param = None
+
+        def __init__(self, param):
+                self.param = param
+
+        def __str__(self):
+                return "%s: %s" % (self.__class__.__name__, self.param)
+
+class MissingParamException(PayloadException):
+        pass
+
+class InvalidParamException(PayloadException):
+        pass
+
+class Field(object):
+        def __init__(self, path, required=False, default=None, kind=None,
+                        convert=None):
+                self.path = path
+                self.parts = tuple(path.split("."))
+                self.name = path.replace(".", "_")
+                self.required = required
+                self.default = default
+                self.kind = kind
+                self.convert = convert
+
+class Schema(object):
+        def __init__(self, *fields):
+                self.fields = fields
+
+        def decode(self, json, prefix=""):
+                if not isinstance(json, dict):
+                        raise InvalidParamException(prefix.rstrip(".") or "payload")
+                decoded = {}
+                for field in self.fields:
+                        value = json
+                        for part in field.parts:
+                                if not isinstance(value, dict) or part not in value:
+                                        value = None
+                                        break
+                                value = value[part]
+                        if value is None:
+                                if field.required:
+                                        raise MissingParamException(prefix + field.path)
+                                decoded[field.name] = field.default
+                                continue
+                        if field.kind is not None and not isinstance(value, field.kind):
+                                raise InvalidParamException(prefix + field.path)
+                        if field.convert is not None:
+                                try:
+                                        value = field.convert(value)
+                                except InvalidParamException:
+                                        raise InvalidParamException(prefix + field.path)
+                        decoded[field.name] = value
+                return decoded
+
+_TIMESTAMP = re.compile(r"^(\d{4})-(\d\d)-(\d\d)T(\d\d):(\d\d):(\d\d)(?:\.\d+)?"
+                r"(Z|[+-]\d\d(?::?\d\d)?)?$")
+_offsets = {"Z": timedelta(0)}
+
+# Returns the timestamp as a naive UTC datetime. A missing offset is taken
+# to already be UTC.
+def parse_timestamp(text):
+        match = _TIMESTAMP.match(text)
+        if match is None:
+                raise InvalidParamException("timestamp")
+        try:
+                timestamp = datetime(*[int(part) for part in match.groups()[:6]])
+        except ValueError:
+                raise InvalidParamException("timestamp")
+        offset = match.group(7)
+        if offset:
+                delta = _offsets.get(offset)
+                if delta is None:
+                        digits = offset[1:].replace(":", "")
+                        delta = timedelta(hours=int(digits[:2]),
+                                        minutes=int(digits[2:] or 0))
+                        if offset[0] == "-":
+                                delta = -delta
+                        _offsets[offset] = delta
+                timestamp = timestamp - delta
+        return timestamp
+
+def email_hash(email):
+        if isinstance(email, unicode):
+                email = email.encode("utf-8")
+        return hashlib.md5(email.strip().lower()).hexdigest()
+
+# Pushes tend to repeat the same few authors, so each payload memoizes the
+# gravatar hash per email instead of hashing once per commit.
+class HashMemo(dict):
+        def __missing__(self, email):
+                self[email] = email_hash(email)
+                return self[email]
+
+STRING = basestring
+
+REPOSITORY = Schema(
+        Field("url", required=True, kind=STRING),
+        Field("owner.email", required=True, kind=STRING),
+        Field("owner.name", required=True, kind=STRING),
+        Field("name", kind=STRING),
+        Field("forks", default=0, kind=(int, long)),
+        Field("watchers", default=0, kind=(int, long)),
+        Field("description", kind=STRING),
+        Field("private", default=False, convert=lambda private: private == 1)
+)
+
+COMMIT = Schema(
+        Field("id", required=True, kind=STRING),
+        Field("url", required=True, kind=STRING),
+        Field("author.email", required=True, kind=STRING),
+        Field("author.name", required=True, kind=STRING),
+        Field("timestamp", kind=STRING, convert=parse_timestamp),
+        Field("message", kind=STRING),
+        Field("added", kind=list)
+)
+
+PUSH = Schema(
+        Field("repository", required=True, kind=dict),
+        Field("commits", required=True, kind=list),
+        Field("pusher.name", kind=STRING)
+)
+
+def decode_repository(json):
+        repository = REPOSITORY.decode(json, "repository.")
+        if repository["name"] is None:
+                repository["name"] = repository["url"].split("/")[-1]
+        repository["owner_hash"] = email_hash(repository["owner_email"])
+        return repository
+
+def decode_commit(json, hashes=None, index=0):
+        commit = COMMIT.decode(json, "commits.%d." % index)
+        if hashes is None:
+                hashes = HashMemo()
+        commit["author_hash"] = hashes[commit["author_email"]]
+        if commit["added"] is None:
+                commit["added"] = []
+        if commit["message"] is not None:
+                commit["summary"] = commit["message"][0:139]
+        else:
+                commit["summary"] = None
+        return commit
+
+# Decodes and validates a whole push before anything is stored, raising a
+# PayloadException if any part of it is malformed.
+def decode_push(text):
+        if not text:
+                raise MissingParamException("payload")
+        try:
+                json = simplejson.loads(text)
+        except ValueError:
+                raise InvalidParamException("payload")
+        push = PUSH.decode(json)
+        hashes = HashMemo()
+        commits = []
+        for index, commit in enumerate(push["commits"]):
+                commits.append(decode_commit(commit, hashes, index))
+        return {
+                "repository": decode_repository(push["repository"]),
+                "commits": commits,
+                "pusher": push["pusher_name"]
+        }
@@ -0,0 +1,88 @@
+import payload
+import profanity
+
+# The webhook-to-dashboard path run synchronously against any Storage, for
+# running GitWatch off App Engine. There the same steps are split between
+# HookReceiver and the /metric and /pusher tasks.
+BOARD_SIZE = 10
+DASHBOARD_COMMITS = 10
+BOARDS = [
+        ("authors", "author", "commit"),
+        ("repos", "repo", "commit"),
+        ("curse_authors", "author", "curse"),
+        ("curse_repos", "repo", "curse"),
+]
+
+# Decodes a push and stores it, returning the repository and the commits
+# that hadn't been seen before.
+def receive(storage, text):
+        push = payload.decode_push(text)
+        repo = storage.find_repository(push["repository"]["url"])
+        if repo is None:
+                repo = storage.add_repository(push["repository"])
+        return repo, storage.add_commits(repo, push["commits"], push["pusher"])
+
+# The (counter name, amount) pairs one commit adds to. repo_url may be None
+# for a commit whose repository is gone.
+def counters_for(email, repo_url, curses_used):
+        scopes = [("global",)]
+        if repo_url is not None:
+                scopes.append(("repo", repo_url))
+        scopes.append(("author", email))
+        amounts = []
+        for scope in scopes:
+                for nature, amount in (("commit", 1), ("curse", curses_used)):
+                        amounts.append((":".join((scope[0], nature) + scope[1:]), amount))
+        return amounts
+
+# Splits a batch of commits into the counters they add to, as
+# [(counter name, [(commit, amount), ...]), ...] with the commits in push
+# order, plus the author names by email as first seen.
+def contributions(repo_url, commits, curse_counts):
+        order = []
+        shares = {}
+        names = {}
+        for commit, curses_used in zip(commits, curse_counts):
+                email = commit["author_email"]
+                names.setdefault(email, commit["author_name"])
+                for name, amount in counters_for(email, repo_url, curses_used):
+                        if name not in shares:
+                                shares[name] = []
+                                order.append(name)
+                        shares[name].append((commit, amount))
+        return [(name, shares[name]) for name in order], names
+
+def deltas(shares):
+        return dict([(name, sum([amount for commit, amount in share]))
+                        for name, share in shares])
+
+def count(storage, repo, commits):
+        claimed = storage.claim_commits([commit["id"] for commit in commits],
+                        profanity.score)
+        shares, names = contributions(repo["url"], claimed,
+                        [commit["num_curses"] for commit in claimed])
+        totals = storage.increment(deltas(shares))
+        storage.put_metrics(totals, names)
+        return totals
+
+def push(storage, text):
+        repo, commits = receive(storage, text)
+        if commits:
+                count(storage, repo, commits)
+        return commits
+
+def dashboard(storage):
+        dashboard = {"commits": storage.recent_commits(DASHBOARD_COMMITS)}
+        for prefix, scope, nature in BOARDS:
+                for order, descending in (("desc", True), ("asc", False)):
+                        board = []
+                        for key, fields, total in storage.top_metrics(scope, nature,
+                                        BOARD_SIZE, descending):
+                                entry = dict(fields)
+                                entry["count"] = total
+                                board.append(entry)
+                        dashboard["%s_%s" % (prefix, order)] = board
+        totals = storage.get_counts(["global:commit", "global:curse"])
+        dashboard["global_commits"] = totals["global:commit"]
+        dashboard["global_curses"] = totals["global:curse"]
+        return dashboard
@@ -0,0 +1,89 @@
+import os
+import re
+import unicodedata
+
+LEXICON_PATH = os.path.join(os.path.dirname(__file__), "profanity.txt")
+
+def normalize(text):
+        if text is None:
+                return u""
+        if not isinstance(text, unicode):
+                text = text.decode("utf-8", "replace")
+        # Fold accents and compatibility forms so accented and fullwidth
+        # letters match the plain lexicon entries.
+        decomposed = unicodedata.normalize("NFKD", text)
+        if decomposed != text:
+                text = u"".join([c for c in decomposed if not unicodedata.combining(c)])
+        return text.lower()
+
+def load_lexicon(path=LEXICON_PATH):
+        words = []
+        for line in open(path):
+                line = line.strip()
+                if line and not line.startswith("#"):
+                        words.append(line)
+        return words
+
+def _trie_pattern(trie):
+        alternatives = []
+        for char in sorted([key for key in trie if key]):
+                alternatives.append(re.escape(char) + _trie_pattern(trie[char]))
+        if not alternatives:
+                return ""
+        if len(alternatives) == 1 and "" not in trie:
+                return alternatives[0]
+        pattern = "(?:" + "|".join(alternatives) + ")"
+        if "" in trie:
+                pattern += "?"
+        return pattern
+
+def _words_pattern(words):
+        # Factoring shared prefixes into a trie keeps the alternation from
+        # retrying every word at every position.
+        trie = {}
+        for word in words:
+                node = trie
+                for char in word:
+                        node = node.setdefault(char, {})
+                node[""] = {}
+        return _trie_pattern(trie)
+
+def compile_lexicon(words):
+        groups = {}
+        for word in words:
+                prefix = word.startswith("*")
+                suffix = word.endswith("*")
+                word = normalize(word.strip("*"))
+                if word:
+                        groups.setdefault((prefix, suffix), []).append(word)
+        alternatives = []
+        for (prefix, suffix), group in sorted(groups.items()):
+                pattern = _words_pattern(group)
+                if not prefix:
+                        pattern = r"(?<!\w)" + pattern
+                if not suffix:
+                        pattern += r"(?!\w)"
+                alternatives.append(pattern)
+        if not alternatives:
+                return None
+        return re.compile("|".join(alternatives), re.UNICODE)
+
+class Detector(object):
+        def __init__(self, words):
+                self.pattern = compile_lexicon(words)
+
+        def count(self, message):
+                if self.pattern is None:
+                        return 0
+                return len(self.pattern.findall(normalize(message)))
+
+        def score(self, messages):
+                return [self.count(message) for message in messages]
+
+detector = Detector(load_lexicon())
+
+def count(message):
+        return detector.count(message)
+
+def score(messages):
+        return detector.score(messages)
@@ -0,0 +1,87 @@
+from google.appengine.api import memcache
+
+# Channel messages are versioned envelopes {"v", "s", "t"} with short field
+# codes. "s" is a broadcast sequence number and "t" the message type:
+#   "c" commits:  "r" [repo name, repo url], "c" rows of [id, url, author,
+#                 author hash, timestamp, summary, pusher]
+#   "m" metrics:  "p" sequence of the previous metrics message, "g" [global
+#                 commits, global curses], "b" leaderboard deltas, "ro" the
+#                 current [minute, commits] rollup bucket
+#   "r" resync:   a metrics message whose deltas rebuild every board
+# A board delta is {"n": length, "d": [[rank, name, count], ...]} and only
+# lists the ranks that changed. A client whose last metrics sequence isn't
+# "p" has missed one and should fetch /state.
+VERSION = 1
+BOARDS = [
+        ("ad", "authors_desc"),
+        ("aa", "authors_asc"),
+        ("rd", "repos_desc"),
+        ("ra", "repos_asc"),
+        ("cad", "curse_authors_desc"),
+        ("crd", "curse_repos_desc"),
+]
+
+def next_seq():
+        return memcache.incr("protocol:seq", initial_value=0)
+
+def _envelope(kind, seq):
+        return {"v": VERSION, "s": seq, "t": kind}
+
+def commits_message(commits):
+        message = _envelope("c", next_seq())
+        message["r"] = [commits[0]["repo_name"], commits[0]["repo_url"]]
+        message["c"] = [[commit["id"], commit["url"], commit["author_name"],
+                commit["author_hash"], commit["timestamp"], commit["message"],
+                commit["pusher"]] for commit in commits]
+        return message
+
+def _state(dashboard, rollup):
+        boards = {}
+        for code, key in BOARDS:
+                boards[code] = [[entry["name"], entry["count"]]
+                                for entry in dashboard[key]]
+        return {"g": [dashboard["global_commits"], dashboard["global_curses"]],
+                "b": boards, "ro": rollup}
+
+def _delta(old, new):
+        changes = []
+        for rank in range(len(new)):
+                if rank >= len(old) or old[rank] != new[rank]:
+                        changes.append([rank] + new[rank])
+        return {"n": len(new), "d": changes}
+
+def metrics_message(dashboard, rollup):
+        state = _state(dashboard, rollup)
+        state["s"] = next_seq()
+        previous = memcache.get("protocol:state")
+        memcache.set("protocol:state", state)
+        message = _envelope("m", state["s"])
+        message["g"] = state["g"]
+        message["ro"] = rollup
+        message["b"] = {}
+        message["p"] = 0
+        if previous is not None:
+                message["p"] = previous["s"]
+        for code, rows in state["b"].items():
+                old = []
+                if previous is not None:
+                        old = previous["b"].get(code, [])
+                delta = _delta(old, rows)
+                if delta["d"] or delta["n"] != len(old):
+                        message["b"][code] = delta
+        return message
+
+# The full state the last metrics message left clients in, for resyncs.
+def resync_message(dashboard, rollup):
+        state = memcache.get("protocol:state")
+        if state is None:
+                state = _state(dashboard, rollup)
+                state["s"] = next_seq()
+                memcache.add("protocol:state", state)
+        message = _envelope("r", state["s"])
+        message["g"] = state["g"]
+        message["ro"] = state["ro"]
+        message["b"] = {}
+        for code, rows in state["b"].items():
+                message["b"][code] = _delta([], rows)
+        return message
@@ -0,0 +1,137 @@
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
+from google.appengine.ext import db
+import time
+
+# Bucket widths in seconds; "event" is a single bucket covering everything.
+RESOLUTIONS = {
+        "minute": 60,
+        "hour": 60 * 60,
+        "event": None,
+}
+MAX_BUCKETS = 1440
+# Bucket values are accumulated in memcache and written behind to the
+# datastore once per flush window.
+FLUSH_WINDOW = 10
+
+class RollupBucket(db.Model):
+        count = db.IntegerProperty(default=0, indexed=False)
+        last_update = db.DateTimeProperty(auto_now=True)
+
+def bucket_start(resolution, timestamp):
+        width = RESOLUTIONS[resolution]
+        if width is None:
+                return 0
+        return int(timestamp) - int(timestamp) % width
+
+def bucket_key(scope, nature, resolution, start):
+        return "%s|%s|%s|%d" % (scope, nature, resolution, start)
+
+# Adds each (scope, nature, delta) to the current bucket of every resolution
+# and returns the new bucket values by bucket key.
+def record(deltas, timestamp=None):
+        if timestamp is None:
+                timestamp = time.time()
+        offsets = {}
+        for scope, nature, delta in deltas:
+                if not delta:
+                        continue
+                for resolution in RESOLUTIONS:
+                        key = bucket_key(scope, nature, resolution,
+                                        bucket_start(resolution, timestamp))
+                        offsets[key] = offsets.get(key, 0) + delta
+        if not offsets:
+                return {}
+        values = memcache.offset_multi(offsets, key_prefix="rollup:",
+                        initial_value=0)
+        # A bucket that just appeared in memcache may have been evicted after
+        # an earlier flush; pick up where the datastore left off.
+        fresh = [key for key in offsets if values.get(key) == offsets[key]]
+        if fresh:
+                seeds = {}
+                for key, bucket in zip(fresh, RollupBucket.get_by_key_name(fresh)):
+                        if bucket is not None and bucket.count:
+                                seeds[key] = bucket.count
+                if seeds:
+                        values.update(memcache.offset_multi(seeds,
+                                        key_prefix="rollup:"))
+        _mark_dirty(offsets.keys())
+        return values
+
+def _mark_dirty(keys):
+        window = int(time.time() / FLUSH_WINDOW)
+        index = memcache.incr("rollup-dirty:%d" % window, initial_value=0)
+        memcache.set("rollup-dirty:%d:%d" % (window, index), list(keys),
+                        time=FLUSH_WINDOW * 10)
+        try:
+                taskqueue.add(url="/rollups/flush", params={"window": window},
+                                name="rollup-flush-%d" % window,
+                                countdown=(window + 1) * FLUSH_WINDOW - time.time() + 1)
+        except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+                pass
+
+def flush(window):
+        count = memcache.get("rollup-dirty:%d" % window)
+        if not count:
+                return
+        chunks = memcache.get_multi(["%d:%d" % (window, index)
+                for index in range(1, int(count) + 1)], key_prefix="rollup-dirty:")
+        keys = {}
+        for chunk in chunks.values():
+                for key in chunk:
+                        keys[key] = True
+        values = memcache.get_multi(keys.keys(), key_prefix="rollup:")
+        names = values.keys()
+        stored = RollupBucket.get_by_key_name(names)
+        updated = []
+        for key, bucket in zip(names, stored):
+                value = int(values[key])
+                if bucket is None:
+                        bucket = RollupBucket(key_name=key)
+                # Racing seeds and flushes can leave memcache briefly behind
+                # the datastore, so never move a bucket backwards.
+                if value > bucket.count:
+                        bucket.count = value
+                        updated.append(bucket)
+        db.put(updated)
+
+def series(scope, nature, resolution, start, end):
+        width = RESOLUTIONS[resolution]
+        if width is None:
+                starts = [0]
+        else:
+                # Clamped before the range is built, so a far-off start can't
+                # make it huge.
+                last = bucket_start(resolution, end)
+                first = max(bucket_start(resolution, start),
+                                last - (MAX_BUCKETS - 1) * width)
+                starts = list(range(first, last + 1, width))
+        keys = [bucket_key(scope, nature, resolution, s) for s in starts]
+        cached = memcache.get_multi(keys, key_prefix="rollup:")
+        stored = RollupBucket.get_by_key_name(keys)
+        points = []
+        for s, key, bucket in zip(starts, keys, stored):
+                count = 0
+                if bucket is not None:
+                        count = bucket.count
+                if key in cached:
+                        count = max(count, int(cached[key]))
+                points.append([s, count])
+        return points
+
+# The current minute and hour buckets of a scope, straight from memcache,
+# for piggybacking on broadcasts.
+def latest(scope, timestamp=None):
+        if timestamp is None:
+                timestamp = time.time()
+        keys = {}
+        for nature in ("commit", "curse"):
+                for resolution in ("minute", "hour"):
+                        start = bucket_start(resolution, timestamp)
+                        keys[bucket_key(scope, nature, resolution, start)] = (
+                                        nature, resolution, start)
+        cached = memcache.get_multi(keys.keys(), key_prefix="rollup:")
+        buckets = {"commit": {}, "curse": {}}
+        for key, (nature, resolution, start) in keys.items():
+                buckets[nature][resolution] = [start, int(cached.get(key, 0))]
+        return buckets
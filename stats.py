@@ -0,0 +1,174 @@
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.api import memcache
+from django.utils import simplejson
+import bisect
+import logging
+import random
+import re
+import time
+
+# Counters are accumulated per instance and added to memcache in one
+# offset_multi at most every FLUSH_INTERVAL seconds.
+FLUSH_INTERVAL = 10
+SERVICES = ["datastore_v3", "memcache", "taskqueue", "channel", "mail", "user"]
+# Histogram buckets are powers of two; a value lands in the first bucket it
+# doesn't exceed.
+BOUNDS = [2 ** i for i in range(24)]
+# Observations that aren't tied to a route, e.g. payload sizes.
+OBSERVATIONS = ["payload_bytes", "commits_per_push"]
+LOG_SAMPLE_RATE = 0.05
+LOG_MAX_BYTES = 1024
+
+_pending = {}
+_last_flush = [time.time()]
+_routes = []
+# Start times keyed by the RPC object, so overlapping async calls each get
+# their own.
+_rpc_started = {}
+_flushing = [False]
+
+def _add(key, delta):
+        _pending[key] = _pending.get(key, 0) + delta
+
+def _bucket(value):
+        return BOUNDS[min(bisect.bisect_left(BOUNDS, value), len(BOUNDS) - 1)]
+
+def observe(name, value):
+        value = int(value)
+        _add(name + ":count", 1)
+        _add(name + ":sum", value)
+        _add("%s:le%d" % (name, _bucket(value)), 1)
+
+# Hooks taking five (pre) and six (post) arguments are passed the rpc, and
+# the post hook its error, so failed calls are timed as well.
+def _pre_call(service, call, request, response, rpc):
+        if _routes and not _flushing[0]:
+                _rpc_started[rpc] = time.time()
+
+def _post_call(service, call, request, response, rpc, error):
+        started = _rpc_started.pop(rpc, None)
+        if _routes and started is not None:
+                elapsed = time.time() - started
+                _add("%s|rpc:%s:calls" % (_routes[-1], service), 1)
+                _add("%s|rpc:%s:us" % (_routes[-1], service), int(elapsed * 1000000))
+
+apiproxy_stub_map.apiproxy.GetPreCallHooks().Append("stats", _pre_call)
+apiproxy_stub_map.apiproxy.GetPostCallHooks().Append("stats", _post_call)
+
+def flush():
+        if not _pending:
+                return
+        _flushing[0] = True
+        try:
+                memcache.offset_multi(_pending, key_prefix="stats:", initial_value=0)
+        finally:
+                _flushing[0] = False
+        _pending.clear()
+        _last_flush[0] = time.time()
+
+def _maybe_flush():
+        if time.time() - _last_flush[0] > FLUSH_INTERVAL:
+                flush()
+
+def sample_log(event, fields, text=None):
+        if random.random() >= LOG_SAMPLE_RATE:
+                return
+        if text is not None:
+                fields = dict(fields)
+                fields["bytes"] = len(text)
+                fields["head"] = text[:LOG_MAX_BYTES]
+        logging.info("%s %s", event, simplejson.dumps(fields))
+
+class StatsMiddleware(object):
+        def __init__(self, application, routes):
+                self.application = application
+                self.routes = [(re.compile("^" + route + "$"), route)
+                                for route, handler in routes]
+
+        def route_for(self, path):
+                for pattern, route in self.routes:
+                        if pattern.match(path):
+                                return route
+                return "unmatched"
+
+        def __call__(self, environ, start_response):
+                route = self.route_for(environ.get("PATH_INFO", ""))
+                status = []
+                def _start_response(code, headers, exc_info=None):
+                        status.append(code)
+                        return start_response(code, headers, exc_info)
+                _routes.append(route)
+                start = time.time()
+                try:
+                        return self.application(environ, _start_response)
+                finally:
+                        _routes.pop()
+                        if not _routes:
+                                # Calls whose post hook never ran.
+                                _rpc_started.clear()
+                        _add(route + "|requests", 1)
+                        if not status or int(status[0].split(" ")[0]) >= 500:
+                                _add(route + "|errors", 1)
+                        observe(route + "|wall_ms", (time.time() - start) * 1000)
+                        _maybe_flush()
+
+def instrument(application, routes):
+        return StatsMiddleware(application, routes)
+
+def _histogram(counters, name):
+        count = counters.get(name + ":count", 0)
+        total = counters.get(name + ":sum", 0)
+        buckets = []
+        for bound in BOUNDS:
+                hits = counters.get("%s:le%d" % (name, bound), 0)
+                if hits:
+                        buckets.append([bound, hits])
+        histogram = {"count": count, "sum": total, "buckets": buckets}
+        if count:
+                histogram["mean"] = float(total) / count
+                for label, fraction in (("p50", 0.5), ("p99", 0.99)):
+                        seen = 0
+                        for bound, hits in buckets:
+                                seen += hits
+                                if seen >= fraction * count:
+                                        histogram[label] = bound
+                                        break
+        return histogram
+
+def _histogram_keys(name):
+        keys = [name + ":count", name + ":sum"]
+        for bound in BOUNDS:
+                keys.append("%s:le%d" % (name, bound))
+        return keys
+
+def snapshot(routes):
+        flush()
+        keys = []
+        for route, handler in routes:
+                keys.extend([route + "|requests", route + "|errors"])
+                keys.extend(_histogram_keys(route + "|wall_ms"))
+                for service in SERVICES:
+                        keys.append("%s|rpc:%s:calls" % (route, service))
+                        keys.append("%s|rpc:%s:us" % (route, service))
+        for name in OBSERVATIONS:
+                keys.extend(_histogram_keys(name))
+        counters = {}
+        for key, value in memcache.get_multi(keys, key_prefix="stats:").items():
+                counters[key] = int(value)
+        report = {"routes": {}}
+        for route, handler in routes:
+                rpcs = {}
+                for service in SERVICES:
+                        calls = counters.get("%s|rpc:%s:calls" % (route, service), 0)
+                        if calls:
+                                rpcs[service] = {"calls": calls, "ms":
+                                        counters.get("%s|rpc:%s:us" % (route, service), 0) / 1000.0}
+                report["routes"][route] = {
+                        "requests": counters.get(route + "|requests", 0),
+                        "errors": counters.get(route + "|errors", 0),
+                        "wall_ms": _histogram(counters, route + "|wall_ms"),
+                        "rpcs": rpcs
+                }
+        for name in OBSERVATIONS:
+                report[name] = _histogram(counters, name)
+        return report
@@ -0,0 +1,368 @@
+import heapq
+import sqlite3
+import time
+try:
+        from django.utils import simplejson
+except ImportError:
+        import json as simplejson
+
+# Repositories, commits, counters and metric rows are reached through a
+# Storage so the webhook-to-dashboard pipeline (see pipeline.py) can run on
+# the datastore or, outside App Engine, on SQLite. Records are plain dicts
+# using the payload module's field names; repositories carry a backend
+# specific "key".
+class Storage(object):
+        # Returns the repository stored for url, or None.
+        def find_repository(self, url):
+                raise NotImplementedError
+
+        # Stores a repository decoded by payload.decode_repository.
+        def add_repository(self, fields):
+                raise NotImplementedError
+
+        # Stores the commits of a push that haven't been seen before and
+        # returns them.
+        def add_commits(self, repo, commits, pusher=None):
+                raise NotImplementedError
+
+        # Removes commits stored by add_commits, so a push whose processing
+        # couldn't be handed on is accepted again when it is redelivered.
+        def discard_commits(self, commits):
+                raise NotImplementedError
+
+        # Marks the stored commits among ids that haven't been counted yet as
+        # counted, sets num_curses from score(messages), and returns them so
+        # each commit is added to the counters once. Commits already claimed
+        # under the same batch name are returned again until the batch is
+        # finished, so a failed batch can be retried.
+        def claim_commits(self, ids, score, batch=None):
+                raise NotImplementedError
+
+        # The newest commits of approved repos, as summarize() dicts.
+        def recent_commits(self, limit):
+                raise NotImplementedError
+
+        # Adds a counter name -> delta map and returns the new totals.
+        def increment(self, deltas):
+                raise NotImplementedError
+
+        # Like increment, but adds each delta at most once per batch name.
+        # Returns the totals and the names this call added.
+        def increment_once(self, batch, deltas):
+                return self.increment(deltas), [name for name in deltas if deltas[name]]
+
+        # Marks a batch complete; its commits can't be claimed again.
+        def finish_batch(self, batch):
+                pass
+
+        def get_counts(self, names):
+                raise NotImplementedError
+
+        # Rewrites the metric rows of the counters in totals; author_names
+        # maps emails to display names.
+        def put_metrics(self, totals, author_names):
+                raise NotImplementedError
+
+        # Every metric row of a scope and nature as (key, fields, count), the
+        # shape leaderboard sources return.
+        def metrics(self, scope, nature):
+                raise NotImplementedError
+
+        def top_metrics(self, scope, nature, limit, descending=True):
+                entries = [entry for entry in self.metrics(scope, nature) if entry[2]]
+                if descending:
+                        return heapq.nlargest(limit, entries, key=lambda entry: entry[2])
+                return heapq.nsmallest(limit, entries, key=lambda entry: entry[2])
+
+        def flush(self):
+                pass
+
+def repo_fields(url):
+        return {"url": url, "name": url.split("/")[-1]}
+
+def metric_fields(scope, subject, name=None):
+        if scope == "repo":
+                return repo_fields(subject)
+        if scope == "author":
+                return {"name": name}
+        return {}
+
+def summarize(commit, repo):
+        return {
+                "id": commit["id"],
+                "url": commit["url"],
+                "author_name": commit["author_name"],
+                "author_hash": commit["author_hash"],
+                "timestamp": str(commit["timestamp"]),
+                "summary": commit["summary"],
+                "pusher": commit["pusher"],
+                "repo_name": repo["name"],
+                "repo_url": repo["url"]
+        }
+
+# Counter names are "scope:nature[:subject]".
+def split_counter(name):
+        parts = name.split(":", 2)
+        if len(parts) == 2:
+                parts.append("")
+        return parts
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS repositories (
+        id INTEGER PRIMARY KEY,
+        url TEXT NOT NULL UNIQUE,
+        name TEXT NOT NULL,
+        owner_name TEXT NOT NULL,
+        owner_email TEXT NOT NULL,
+        owner_hash TEXT,
+        description TEXT,
+        forks INTEGER NOT NULL,
+        watchers INTEGER NOT NULL,
+        private INTEGER NOT NULL DEFAULT 0,
+        approved INTEGER NOT NULL DEFAULT 0,
+        rejected INTEGER NOT NULL DEFAULT 0,
+        first_seen TEXT NOT NULL,
+        last_update TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS commits (
+        id TEXT PRIMARY KEY,
+        repository INTEGER NOT NULL REFERENCES repositories (id),
+        url TEXT NOT NULL,
+        author_name TEXT NOT NULL,
+        author_email TEXT NOT NULL,
+        author_hash TEXT,
+        pusher TEXT,
+        timestamp TEXT,
+        message TEXT,
+        summary TEXT,
+        added TEXT,
+        num_curses INTEGER NOT NULL DEFAULT 0,
+        repo_approved INTEGER NOT NULL DEFAULT 0,
+        received TEXT NOT NULL,
+        counted INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS commits_feed ON commits (repo_approved, timestamp DESC);
+CREATE INDEX IF NOT EXISTS commits_repository ON commits (repository);
+CREATE TABLE IF NOT EXISTS counters (
+        name TEXT PRIMARY KEY,
+        count INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS metrics (
+        scope TEXT NOT NULL,
+        nature TEXT NOT NULL,
+        subject TEXT NOT NULL,
+        name TEXT,
+        count INTEGER NOT NULL,
+        PRIMARY KEY (scope, nature, subject)
+);
+CREATE INDEX IF NOT EXISTS metrics_rank ON metrics (scope, nature, count);
+"""
+
+# SQLite caps bound parameters per statement at 999.
+SQLITE_BATCH = 500
+
+def _now():
+        return time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime())
+
+def _chunks(items, size=SQLITE_BATCH):
+        for start in range(0, len(items), size):
+                yield items[start:start + size]
+
+def _placeholders(items):
+        return ",".join(["?"] * len(items))
+
+# A single-process SQLite store for running GitWatch off App Engine. Every
+# call commits one transaction, and counter totals are kept in memory and
+# written behind every FLUSH_INTERVAL seconds, so only one process may use
+# a database file at a time.
+class SQLiteStorage(Storage):
+        FLUSH_INTERVAL = 5
+
+        def __init__(self, path, auto_approve=False):
+                self.connection = sqlite3.connect(path)
+                self.connection.row_factory = sqlite3.Row
+                self.connection.execute("PRAGMA journal_mode=WAL")
+                self.connection.execute("PRAGMA synchronous=NORMAL")
+                self.connection.executescript(SCHEMA)
+                self.auto_approve = auto_approve
+                self.counts = {}
+                self.dirty = set()
+                self.last_flush = time.time()
+
+        def _repository(self, row):
+                if row is None:
+                        return None
+                repo = dict(zip(row.keys(), row))
+                repo["key"] = repo.pop("id")
+                repo["approved"] = bool(repo["approved"])
+                return repo
+
+        def find_repository(self, url):
+                return self._repository(self.connection.execute(
+                                "SELECT * FROM repositories WHERE url = ?", (url,)).fetchone())
+
+        def add_repository(self, fields):
+                now = _now()
+                self.connection.execute("INSERT INTO repositories (url, name, "
+                                "owner_name, owner_email, owner_hash, description, forks, "
+                                "watchers, private, approved, first_seen, last_update) "
+                                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                (fields["url"], fields["name"], fields["owner_name"],
+                                 fields["owner_email"], fields["owner_hash"],
+                                 fields["description"], fields["forks"],
+                                 fields["watchers"], int(fields["private"]),
+                                 int(self.auto_approve), now, now))
+                self.connection.commit()
+                return self.find_repository(fields["url"])
+
+        def add_commits(self, repo, commits, pusher=None):
+                unseen = {}
+                for commit in commits:
+                        unseen.setdefault(commit["id"], commit)
+                for batch in _chunks(list(unseen.keys())):
+                        for row in self.connection.execute("SELECT id FROM commits "
+                                        "WHERE id IN (%s)" % _placeholders(batch), batch):
+                                del unseen[row[0]]
+                new = []
+                for commit in commits:
+                        if unseen.pop(commit["id"], None) is not None:
+                                commit = dict(commit)
+                                commit["pusher"] = pusher
+                                new.append(commit)
+                if not new:
+                        return []
+                now = _now()
+                rows = []
+                for commit in new:
+                        timestamp = now
+                        if commit["timestamp"] is not None:
+                                timestamp = str(commit["timestamp"])
+                        rows.append((commit["id"], repo["key"], commit["url"],
+                                commit["author_name"], commit["author_email"],
+                                commit["author_hash"], pusher, timestamp,
+                                commit["message"], commit["summary"],
+                                simplejson.dumps(commit["added"]),
+                                int(repo["approved"]), now))
+                self.connection.executemany("INSERT INTO commits (id, repository, "
+                                "url, author_name, author_email, author_hash, pusher, "
+                                "timestamp, message, summary, added, repo_approved, "
+                                "received) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                rows)
+                self.connection.execute("UPDATE repositories SET last_update = ? "
+                                "WHERE id = ?", (now, repo["key"]))
+                self.connection.commit()
+                return new
+
+        def discard_commits(self, commits):
+                for batch in _chunks([commit["id"] for commit in commits]):
+                        self.connection.execute("DELETE FROM commits WHERE id IN (%s)"
+                                        % _placeholders(batch), batch)
+                self.connection.commit()
+
+        def _commit(self, row):
+                commit = dict(zip(row.keys(), row))
+                commit["added"] = simplejson.loads(commit["added"])
+                commit["repo_approved"] = bool(commit["repo_approved"])
+                return commit
+
+        # Each call is a single transaction, so batches never need retrying.
+        def claim_commits(self, ids, score, batch=None):
+                pending = {}
+                for batch in _chunks(list(ids)):
+                        for row in self.connection.execute("SELECT * FROM commits "
+                                        "WHERE id IN (%s) AND counted = 0" % _placeholders(batch),
+                                        batch):
+                                pending[row["id"]] = self._commit(row)
+                claimed = []
+                for id in ids:
+                        if id in pending:
+                                claimed.append(pending.pop(id))
+                if not claimed:
+                        return []
+                curse_counts = score([commit["message"] for commit in claimed])
+                for commit, curses_used in zip(claimed, curse_counts):
+                        commit["num_curses"] = curses_used
+                self.connection.executemany("UPDATE commits SET counted = 1, "
+                                "num_curses = ? WHERE id = ?",
+                                [(commit["num_curses"], commit["id"]) for commit in claimed])
+                self.connection.commit()
+                return claimed
+
+        def recent_commits(self, limit):
+                rows = self.connection.execute("SELECT commits.*, repositories.name "
+                                "AS repo_name, repositories.url AS repo_url FROM commits "
+                                "JOIN repositories ON repositories.id = commits.repository "
+                                "WHERE commits.repo_approved = 1 AND repositories.approved = 1 "
+                                "ORDER BY commits.timestamp DESC LIMIT ?", (limit,))
+                return [summarize(row, {"name": row["repo_name"], "url": row["repo_url"]})
+                                for row in rows]
+
+        def _load(self, names):
+                missing = [name for name in names if name not in self.counts]
+                for batch in _chunks(missing):
+                        for name in batch:
+                                self.counts[name] = 0
+                        for row in self.connection.execute("SELECT name, count FROM "
+                                        "counters WHERE name IN (%s)" % _placeholders(batch),
+                                        batch):
+                                self.counts[row[0]] = row[1]
+
+        def increment(self, deltas):
+                self._load(list(deltas.keys()))
+                totals = {}
+                for name, delta in deltas.items():
+                        if delta:
+                                self.counts[name] += delta
+                                self.dirty.add(name)
+                        totals[name] = self.counts[name]
+                if time.time() - self.last_flush > self.FLUSH_INTERVAL:
+                        self.flush()
+                return totals
+
+        def get_counts(self, names):
+                self._load(names)
+                return dict([(name, self.counts[name]) for name in names])
+
+        def flush(self):
+                if self.dirty:
+                        self.connection.executemany("INSERT OR REPLACE INTO counters "
+                                        "(name, count) VALUES (?, ?)",
+                                        [(name, self.counts[name]) for name in self.dirty])
+                        self.connection.commit()
+                        self.dirty.clear()
+                self.last_flush = time.time()
+
+        def close(self):
+                self.flush()
+                self.connection.close()
+
+        def put_metrics(self, totals, author_names):
+                rows = []
+                for name, count in totals.items():
+                        scope, nature, subject = split_counter(name)
+                        rows.append((count, author_names.get(subject), scope, nature,
+                                        subject))
+                self.connection.executemany("INSERT OR IGNORE INTO metrics (count, "
+                                "name, scope, nature, subject) VALUES (?, ?, ?, ?, ?)", rows)
+                self.connection.executemany("UPDATE metrics SET count = ?, "
+                                "name = coalesce(?, name) WHERE scope = ? AND nature = ? "
+                                "AND subject = ?", rows)
+                self.connection.commit()
+
+        def _entries(self, scope, nature, rows):
+                return [(nature + ":" + row[0], metric_fields(scope, row[0], row[1]),
+                                row[2]) for row in rows]
+
+        def metrics(self, scope, nature):
+                return self._entries(scope, nature, self.connection.execute(
+                                "SELECT subject, name, count FROM metrics WHERE scope = ? "
+                                "AND nature = ?", (scope, nature)))
+
+        def top_metrics(self, scope, nature, limit, descending=True):
+                order = "ASC"
+                if descending:
+                        order = "DESC"
+                return self._entries(scope, nature, self.connection.execute(
+                                "SELECT subject, name, count FROM metrics WHERE scope = ? "
+                                "AND nature = ? AND count > 0 ORDER BY count %s LIMIT ?" % order,
+                                (scope, nature, limit)))
@@ -0,0 +1,91 @@
+from google.appengine.api import channel
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
+from google.appengine.ext import db
+from django.utils import simplejson
+import time
+import zlib
+
+# Subscribers are spread over buckets so each broadcast fans out into
+# NUM_BUCKETS independent tasks instead of one serial loop over every client.
+NUM_BUCKETS = 8
+# Channel tokens are only valid for two hours.
+LIFETIME = 60 * 60 * 2
+CACHE_TIME = 30
+RETRIES = 5
+
+class Subscriber(db.Model):
+        client_id = db.StringProperty(required=True)
+        bucket = db.IntegerProperty(required=True)
+        expires = db.FloatProperty(required=True)
+
+def bucket_for(client_id):
+        return (zlib.crc32(client_id) & 0xffffffff) % NUM_BUCKETS
+
+def _cache_key(bucket):
+        return "subscribers:%d" % bucket
+
+# Each bucket's subscribers share a parent, so reading a bucket is an
+# ancestor query and sees every subscribe that finished before it.
+def bucket_key(bucket):
+        return db.Key.from_path("SubscriberBucket", bucket)
+
+def _load_bucket(bucket):
+        now = time.time()
+        clients = []
+        expired = []
+        for subscriber in Subscriber.all().ancestor(bucket_key(bucket)):
+                if subscriber.expires > now:
+                        clients.append((subscriber.client_id, subscriber.expires))
+                else:
+                        expired.append(subscriber.key())
+        db.delete(expired)
+        return clients
+
+def subscribe(client_id):
+        bucket = bucket_for(client_id)
+        expires = time.time() + LIFETIME
+        Subscriber(parent=bucket_key(bucket), key_name="client:" + client_id,
+                        client_id=client_id, bucket=bucket, expires=expires).put()
+        # The cached list is updated in place rather than deleted: a reader
+        # that loaded the bucket before the put could otherwise cache it
+        # again without this client. If nothing is cached, a list loaded
+        # after the put is added, and a reader's older list then can't be.
+        client = memcache.Client()
+        key = _cache_key(bucket)
+        for attempt in range(RETRIES):
+                clients = client.gets(key)
+                if clients is None:
+                        if client.add(key, _load_bucket(bucket), time=CACHE_TIME):
+                                return
+                        continue
+                clients = [entry for entry in clients if entry[0] != client_id]
+                clients.append((client_id, expires))
+                if client.cas(key, clients, time=CACHE_TIME):
+                        return
+        memcache.delete(key)
+
+def get_bucket(bucket):
+        clients = memcache.get(_cache_key(bucket))
+        if clients is None:
+                clients = _load_bucket(bucket)
+                memcache.add(_cache_key(bucket), clients, time=CACHE_TIME)
+        return clients
+
+def broadcast(messages):
+        # Each message is encoded once here rather than once per client.
+        encoded = [simplejson.dumps(message, separators=(",", ":"))
+                        for message in messages]
+        payload = simplejson.dumps(encoded)
+        tasks = []
+        for bucket in range(NUM_BUCKETS):
+                tasks.append(taskqueue.Task(url="/fanout", params={
+                        "bucket": bucket, "messages": payload}))
+        taskqueue.Queue().add(tasks)
+
+def send_to_bucket(bucket, messages):
+        now = time.time()
+        for client_id, expires in get_bucket(bucket):
+                if expires > now:
+                        for message in messages:
+                                channel.send_message(client_id, message)
@@ -0,0 +1,116 @@
+from datetime import datetime
+import sys
+import unittest
+
+import payload
+
+REPOSITORY = {"url": "https://github.com/paddyforan/gitwatch",
+        "owner": {"email": "paddy@example.com", "name": "paddyforan"}}
+COMMIT = {"id": "41a212ee83ca127e3c8cf465891ab7216a705f59",
+        "url": "https://github.com/paddyforan/gitwatch/commit/41a212ee",
+        "author": {"email": "nick@example.com", "name": "Nick"},
+        "timestamp": "2012-11-10T17:30:06-08:00",
+        "message": "Fix the dashboard"}
+
+def push(**overrides):
+        body = {"repository": REPOSITORY, "commits": [COMMIT],
+                "pusher": {"name": "paddyforan"}}
+        body.update(overrides)
+        return payload.simplejson.dumps(body)
+
+def commit(**overrides):
+        body = dict(COMMIT)
+        body.update(overrides)
+        return body
+
+class ParseTimestampTest(unittest.TestCase):
+        def test_utc(self):
+                self.assertEqual(payload.parse_timestamp("2012-11-10T17:30:06Z"),
+                                datetime(2012, 11, 10, 17, 30, 6))
+
+        def test_no_offset_is_utc(self):
+                self.assertEqual(payload.parse_timestamp("2012-11-10T17:30:06"),
+                                datetime(2012, 11, 10, 17, 30, 6))
+
+        def test_offsets(self):
+                for text in ("2012-11-10T17:30:06-08:00", "2012-11-10T17:30:06-0800",
+                                "2012-11-10T17:30:06-08"):
+                        self.assertEqual(payload.parse_timestamp(text),
+                                        datetime(2012, 11, 11, 1, 30, 6))
+                self.assertEqual(payload.parse_timestamp("2012-11-10T17:30:06+05:30"),
+                                datetime(2012, 11, 10, 12, 0, 6))
+
+        def test_fractional_seconds(self):
+                self.assertEqual(payload.parse_timestamp("2012-11-10T17:30:06.25Z"),
+                                datetime(2012, 11, 10, 17, 30, 6))
+
+        def test_invalid(self):
+                for text in ("", "yesterday", "2012-11-10 17:30:06",
+                                "2012-13-10T17:30:06Z", "2012-11-10T17:30:06+8"):
+                        self.assertRaises(payload.InvalidParamException,
+                                        payload.parse_timestamp, text)
+
+class DecodePushTest(unittest.TestCase):
+        def assertRejected(self, exception, param, text):
+                try:
+                        payload.decode_push(text)
+                except exception:
+                        self.assertEqual(sys.exc_info()[1].param, param)
+                else:
+                        self.fail("%s accepted" % text)
+
+        def test_decodes(self):
+                decoded = payload.decode_push(push())
+                self.assertEqual(decoded["pusher"], "paddyforan")
+                self.assertEqual(decoded["repository"]["name"], "gitwatch")
+                self.assertEqual(decoded["repository"]["owner_hash"],
+                                payload.email_hash("paddy@example.com"))
+                self.assertEqual(len(decoded["commits"]), 1)
+                self.assertEqual(decoded["commits"][0]["summary"], "Fix the dashboard")
+                self.assertEqual(decoded["commits"][0]["added"], [])
+
+        def test_empty(self):
+                self.assertRejected(payload.MissingParamException, "payload", "")
+
+        def test_bad_json(self):
+                self.assertRejected(payload.InvalidParamException, "payload", "{")
+
+        def test_not_an_object(self):
+                self.assertRejected(payload.InvalidParamException, "payload", "[]")
+
+        def test_missing_repository(self):
+                self.assertRejected(payload.MissingParamException, "repository",
+                                payload.simplejson.dumps({"commits": []}))
+
+        def test_missing_owner(self):
+                self.assertRejected(payload.MissingParamException,
+                                "repository.owner.email",
+                                push(repository={"url": REPOSITORY["url"]}))
+
+        def test_commits_not_a_list(self):
+                self.assertRejected(payload.InvalidParamException, "commits",
+                                push(commits={"id": COMMIT["id"]}))
+
+        def test_commit_not_an_object(self):
+                self.assertRejected(payload.InvalidParamException, "commits.0",
+                                push(commits=["41a212ee"]))
+
+        def test_missing_commit_id(self):
+                body = commit()
+                del body["id"]
+                self.assertRejected(payload.MissingParamException, "commits.1.id",
+                                push(commits=[COMMIT, body]))
+
+        def test_wrong_types(self):
+                self.assertRejected(payload.InvalidParamException, "commits.0.message",
+                                push(commits=[commit(message=42)]))
+                self.assertRejected(payload.InvalidParamException, "repository.forks",
+                                push(repository=dict(REPOSITORY, forks="many")))
+
+        def test_bad_timestamp(self):
+                self.assertRejected(payload.InvalidParamException,
+                                "commits.0.timestamp",
+                                push(commits=[commit(timestamp="yesterday")]))
+
+if __name__ == "__main__":
+        unittest.main()
@@ -0,0 +1,115 @@
+import unittest
+
+import pipeline
+import storage
+
+URL = "https://github.com/paddyforan/gitwatch"
+
+def push(commits, url=URL):
+        return storage.simplejson.dumps({
+                "repository": {"url": url,
+                        "owner": {"email": "paddy@example.com", "name": "paddyforan"}},
+                "commits": [{"id": id, "url": url + "/commit/" + id,
+                        "author": {"email": email, "name": email.split("@")[0]},
+                        "timestamp": "2012-11-10T17:30:%02dZ" % index,
+                        "message": message}
+                        for index, (id, email, message) in enumerate(commits)],
+                "pusher": {"name": "paddyforan"}})
+
+class TallyTest(unittest.TestCase):
+        def test_counters_for(self):
+                self.assertEqual(pipeline.counters_for("nick@example.com", URL, 2), [
+                        ("global:commit", 1), ("global:curse", 2),
+                        ("repo:commit:" + URL, 1), ("repo:curse:" + URL, 2),
+                        ("author:commit:nick@example.com", 1),
+                        ("author:curse:nick@example.com", 2)])
+                self.assertEqual([name for name, amount in pipeline.counters_for(
+                                "nick@example.com", None, 0)], ["global:commit",
+                                "global:curse", "author:commit:nick@example.com",
+                                "author:curse:nick@example.com"])
+
+        def test_contributions(self):
+                first = {"author_email": "nick@example.com", "author_name": "Nick"}
+                second = {"author_email": "paddy@example.com", "author_name": "Paddy"}
+                third = {"author_email": "nick@example.com", "author_name": "nick"}
+                shares, names = pipeline.contributions(URL, [first, second, third],
+                                [1, 0, 2])
+                self.assertEqual([name for name, share in shares][:6], [
+                        "global:commit", "global:curse", "repo:commit:" + URL,
+                        "repo:curse:" + URL, "author:commit:nick@example.com",
+                        "author:curse:nick@example.com"])
+                self.assertEqual(dict(shares)["author:curse:nick@example.com"],
+                                [(first, 1), (third, 2)])
+                self.assertEqual(names, {"nick@example.com": "Nick",
+                                "paddy@example.com": "Paddy"})
+                deltas = pipeline.deltas(shares)
+                self.assertEqual(deltas["global:commit"], 3)
+                self.assertEqual(deltas["global:curse"], 3)
+                self.assertEqual(deltas["author:curse:paddy@example.com"], 0)
+
+class PipelineTest(unittest.TestCase):
+        def setUp(self):
+                self.store = storage.SQLiteStorage(":memory:", auto_approve=True)
+
+        def tearDown(self):
+                self.store.close()
+
+        def counts(self, *names):
+                return self.store.get_counts(list(names))
+
+        def test_redelivered_push_counted_once(self):
+                body = push([("a1", "nick@example.com", "Fix the build"),
+                        ("b2", "paddy@example.com", "damn typo")])
+                self.assertEqual(len(pipeline.push(self.store, body)), 2)
+                self.assertEqual(pipeline.push(self.store, body), [])
+                self.assertEqual(self.counts("global:commit", "global:curse"),
+                                {"global:commit": 2, "global:curse": 1})
+
+        def test_commits_counted_once(self):
+                repo, commits = pipeline.receive(self.store,
+                                push([("a1", "nick@example.com", "shit")]))
+                pipeline.count(self.store, repo, commits)
+                self.assertEqual(pipeline.count(self.store, repo, commits), {})
+                self.assertEqual(self.counts("global:commit")["global:commit"], 1)
+
+        def test_curse_totals_per_scope(self):
+                other = URL + "-fork"
+                pipeline.push(self.store, push([
+                        ("a1", "nick@example.com", "damn, damn it"),
+                        ("b2", "paddy@example.com", "what the hell"),
+                        ("c3", "nick@example.com", "Add tests")]))
+                pipeline.push(self.store, push([
+                        ("d4", "nick@example.com", "shit")], other))
+                self.assertEqual(self.counts("global:commit", "global:curse",
+                                "repo:curse:" + URL, "repo:curse:" + other,
+                                "author:curse:nick@example.com",
+                                "author:curse:paddy@example.com",
+                                "author:commit:nick@example.com"), {
+                        "global:commit": 4, "global:curse": 4,
+                        "repo:curse:" + URL: 3, "repo:curse:" + other: 1,
+                        "author:curse:nick@example.com": 3,
+                        "author:curse:paddy@example.com": 1,
+                        "author:commit:nick@example.com": 3})
+
+        def test_dashboard_boards(self):
+                commits = []
+                for index, email in enumerate(["ada@example.com"] * 3 +
+                                ["ken@example.com"] + ["tim@example.com"] * 2):
+                        commits.append(("c%d" % index, email, "Commit %d" % index))
+                pipeline.push(self.store, push(commits))
+                dashboard = pipeline.dashboard(self.store)
+                self.assertEqual([(entry["name"], entry["count"])
+                                for entry in dashboard["authors_desc"]],
+                                [("ada", 3), ("tim", 2), ("ken", 1)])
+                self.assertEqual([(entry["name"], entry["count"])
+                                for entry in dashboard["authors_asc"]],
+                                [("ken", 1), ("tim", 2), ("ada", 3)])
+                self.assertEqual(dashboard["curse_authors_desc"], [])
+                self.assertEqual(dashboard["repos_desc"], [{"url": URL,
+                                "name": "gitwatch", "count": 6}])
+                self.assertEqual(dashboard["global_commits"], 6)
+                self.assertEqual([commit["id"] for commit in dashboard["commits"]][:2],
+                                ["c5", "c4"])
+
+if __name__ == "__main__":
+        unittest.main()
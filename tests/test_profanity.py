@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+import unittest
+
+import profanity
+
+class DetectorTest(unittest.TestCase):
+        def setUp(self):
+                self.detector = profanity.Detector(["ass", "*shit*", "damn*"])
+
+        def test_whole_words(self):
+                self.assertEqual(self.detector.count("kick ass"), 1)
+                self.assertEqual(self.detector.count("pass the assert"), 0)
+
+        def test_wildcards(self):
+                self.assertEqual(self.detector.count("bullshit, shitty"), 2)
+                self.assertEqual(self.detector.count("damnit"), 1)
+                self.assertEqual(self.detector.count("goddamn"), 0)
+
+        def test_case_and_accents(self):
+                self.assertEqual(self.detector.count(u"SHÏT"), 1)
+                self.assertEqual(self.detector.count("Sh\xc3\xaft"), 1)
+
+        def test_empty(self):
+                self.assertEqual(self.detector.count(None), 0)
+                self.assertEqual(profanity.Detector([]).count("shit"), 0)
+
+        def test_score(self):
+                self.assertEqual(self.detector.score(["ass", "fine", "shit shit"]),
+                                [1, 0, 2])
+
+        def test_lexicon(self):
+                self.assertEqual(profanity.count("What the fuck, bullshit"), 2)
+
+if __name__ == "__main__":
+        unittest.main()
@@ -0,0 +1,95 @@
+import unittest
+
+import payload
+import storage
+
+REPOSITORY = {"url": "https://github.com/paddyforan/gitwatch",
+        "owner": {"email": "paddy@example.com", "name": "paddyforan"}}
+
+def commit(id, email="nick@example.com", timestamp="2012-11-10T17:30:06Z"):
+        return payload.decode_commit({"id": id,
+                "url": "https://github.com/paddyforan/gitwatch/commit/" + id,
+                "author": {"email": email, "name": email.split("@")[0]},
+                "timestamp": timestamp, "message": "Commit " + id})
+
+class SQLiteStorageTest(unittest.TestCase):
+        def setUp(self):
+                self.store = storage.SQLiteStorage(":memory:", auto_approve=True)
+                self.repo = self.store.add_repository(
+                                payload.decode_repository(REPOSITORY))
+
+        def tearDown(self):
+                self.store.close()
+
+        def test_repository(self):
+                self.assertEqual(self.store.find_repository(REPOSITORY["url"])["key"],
+                                self.repo["key"])
+                self.assertTrue(self.repo["approved"])
+                self.assertEqual(self.store.find_repository("https://example.com"), None)
+
+        def test_add_commits_skips_seen(self):
+                added = self.store.add_commits(self.repo, [commit("a1"), commit("b2"),
+                                commit("a1")], "paddyforan")
+                self.assertEqual([cmt["id"] for cmt in added], ["a1", "b2"])
+                self.assertEqual(added[0]["pusher"], "paddyforan")
+                added = self.store.add_commits(self.repo, [commit("b2"), commit("c3")])
+                self.assertEqual([cmt["id"] for cmt in added], ["c3"])
+
+        def test_discard_commits(self):
+                added = self.store.add_commits(self.repo, [commit("a1"), commit("b2")])
+                self.store.discard_commits(added[:1])
+                added = self.store.add_commits(self.repo, [commit("a1"), commit("b2")])
+                self.assertEqual([cmt["id"] for cmt in added], ["a1"])
+
+        def test_claim_commits(self):
+                self.store.add_commits(self.repo, [commit("a1"), commit("b2")])
+                claimed = self.store.claim_commits(["b2", "a1", "c3"],
+                                lambda messages: [len(message) for message in messages])
+                self.assertEqual([cmt["id"] for cmt in claimed], ["b2", "a1"])
+                self.assertEqual(claimed[0]["num_curses"], len("Commit b2"))
+                self.assertEqual(claimed[0]["added"], [])
+                self.assertEqual(self.store.claim_commits(["a1", "b2"],
+                                lambda messages: [0] * len(messages)), [])
+
+        def test_recent_commits(self):
+                self.store.add_commits(self.repo, [
+                        commit("a1", timestamp="2012-11-10T17:30:06Z"),
+                        commit("b2", timestamp="2012-11-10T18:30:06Z"),
+                        commit("c3", timestamp="2012-11-10T16:30:06Z")])
+                recent = self.store.recent_commits(2)
+                self.assertEqual([cmt["id"] for cmt in recent], ["b2", "a1"])
+                self.assertEqual(recent[0]["repo_name"], "gitwatch")
+
+        def test_unapproved_commits_hidden(self):
+                store = storage.SQLiteStorage(":memory:")
+                repo = store.add_repository(payload.decode_repository(REPOSITORY))
+                store.add_commits(repo, [commit("a1")])
+                self.assertEqual(store.recent_commits(10), [])
+                store.close()
+
+        def test_counters(self):
+                self.assertEqual(self.store.increment({"global:commit": 2,
+                                "global:curse": 0}), {"global:commit": 2, "global:curse": 0})
+                self.assertEqual(self.store.increment({"global:commit": 3}),
+                                {"global:commit": 5})
+                self.store.flush()
+                self.store.counts = {}
+                self.assertEqual(self.store.get_counts(["global:commit", "global:curse"]),
+                                {"global:commit": 5, "global:curse": 0})
+
+        def test_metrics(self):
+                self.store.put_metrics({"author:commit:nick@example.com": 3,
+                        "author:commit:paddy@example.com": 5,
+                        "author:commit:zero@example.com": 0},
+                        {"nick@example.com": "Nick", "paddy@example.com": "Paddy"})
+                self.store.put_metrics({"author:commit:nick@example.com": 7}, {})
+                top = self.store.top_metrics("author", "commit", 10)
+                self.assertEqual(top, [
+                        ("commit:nick@example.com", {"name": "Nick"}, 7),
+                        ("commit:paddy@example.com", {"name": "Paddy"}, 5)])
+                self.assertEqual(self.store.top_metrics("author", "commit", 1, False),
+                                [("commit:paddy@example.com", {"name": "Paddy"}, 5)])
+                self.assertEqual(len(self.store.metrics("author", "commit")), 3)
+
+if __name__ == "__main__":
+        unittest.main()